@@ -5,6 +5,7 @@ import cv2
 import copy
 import time
 import math
+from TangramsStats import instrument
 
 NON_CONNECTION = -1
 SIDE_SIDE = 0
@@ -17,12 +18,38 @@ MAX_POINT_SIDE_DIST = 20
 MAX_CENTER_DIST = 50
 MAX_ANG_DIFF = 0.5
 MAX_CONNECTION_DIST = 250
+#Most pairs of pieces a ConnectionCache keeps, and the pixels it rounds their
+#relative poses to. Contours are in whole pixels, so half a pixel only joins
+#poses that are the same.
+CONNECTION_CACHE_SIZE = 10000
+CONNECTION_CACHE_QUANTUM = 0.5
+#Set in a contact index for a side, clear for a contour point.
+SIDE_CONTACT = 0x80
+
+#Area limits in pixels of a contour that can be a piece.
+MIN_BLOCK_AREA = 100
+MAX_BLOCK_AREA = 100000
+#Contours whose centers are closer than this, in pixels, and that overlap by
+#more than MAX_DUPLICATE_OVERLAP of the smaller one are the same piece.
+MIN_DUPLICATE_DIST = 20
+MAX_DUPLICATE_OVERLAP = 0.5
+#Pixels around a coarse contour, per pixel of the downscaled frame, that are
+#segmented again at full resolution to refine it.
+REFINE_MARGIN = 4
+#Times the refine windows may grow to fit blocks cut by their edges.
+REFINE_GROWTH = 3
+#Fraction of MIN_BLOCK_AREA a coarse block needs to be refined.
+REFINE_MIN_AREA = 0.25
 
 class Connection:
 
-    def __init__(self, piece1, piece2):
+    def __init__(self, piece1, piece2, findType = True):
         self.pieces = [piece1, piece2]
-        self.determineConnectionType()
+        #Innocent of connection-ness until proven connected.
+        self.connectionType = NON_CONNECTION
+        #The batched engine in findConnections sets the contacts itself.
+        if findType:
+            self.determineConnectionType()
 
     #Determines the type of connection this is.
     def determineConnectionType(self):
@@ -33,29 +60,13 @@ class Connection:
             #Looking for SIDE_SIDE
             for otherSide in self.pieces[1].sides:
                 if( self.isSideSideConnection(side, otherSide) ):
-                    self.connectionType = SIDE_SIDE
-                    self.touching = [side, otherSide]
-                    #Retrieve and store location numbers.
-                    self.locationNumbers = [
-                        self.pieces[0].getLocationNumber(side),
-                        self.pieces[1].getLocationNumber(otherSide)
-                    ]
-                    # print("Location numbers SIDE_SIDE")
-                    # print( self.locationNumbers )
+                    self.setContacts(SIDE_SIDE, side, otherSide)
                     return
 
             #Looking for SIDE_POINT
             for otherPoint in self.pieces[1].contour:
                 if( self.isSidePointConnection(side, otherPoint) ):
-                    self.connectionType = SIDE_POINT
-                    self.touching = [Point(otherPoint), side]
-                    #Retrieve and store location numbers.
-                    self.locationNumbers = [
-                        self.pieces[0].getLocationNumber(side),
-                        self.pieces[1].getLocationNumber(otherPoint)
-                    ]
-                    # print("Location numbers SIDE_POINT")
-                    # print( self.locationNumbers )
+                    self.setContacts(SIDE_POINT, side, otherPoint)
                     return
 
         #Loop for each point in the first piece.
@@ -63,31 +74,41 @@ class Connection:
             #Looking for POINT_POINT connection.
             for otherPoint in self.pieces[1].contour:
                 if( self.isPointPointConnection(point, otherPoint) ):
-                    self.connectionType = POINT_POINT
-                    self.touching = [Point(point), Point(otherPoint)]
-                    #Retrieve and store location numbers.
-                    self.locationNumbers = [
-                        self.pieces[0].getLocationNumber(point),
-                        self.pieces[1].getLocationNumber(otherPoint)
-                    ]
-                    # print("Location numbers POINT_POINT")
-                    # print( self.locationNumbers )
+                    self.setContacts(POINT_POINT, point, otherPoint)
                     return
 
             #Looking for a SIDE_POINT connection.
             for otherSide in self.pieces[1].sides:
                 if( self.isSidePointConnection(otherSide, point) ):
-                    self.connectionType = SIDE_POINT
-                    self.touching = [Point(point), otherSide]
-                    #Retrieve and store location numbers.
-                    self.locationNumbers = [
-                        self.pieces[0].getLocationNumber(point),
-                        self.pieces[1].getLocationNumber(otherSide)
-                    ]
-                    # print("Location numbers POINT_SIDE")
-                    # print( self.locationNumbers )
+                    self.setContacts(SIDE_POINT, point, otherSide)
                     return
 
+    #Stores the connection type, what is touching and the location numbers.
+    #contact is a side or contour point of the first piece and otherContact
+    #is a side or contour point of the second piece. locationNumbers may be
+    #given when they are already known, like when read from a file.
+    def setContacts(self, connectionType, contact, otherContact,
+                    locationNumbers = None):
+        self.connectionType = connectionType
+        touching = []
+        for current in [contact, otherContact]:
+            if isinstance(current, Line):
+                touching.append(current)
+            else:
+                touching.append(Point(current))
+        #SIDE_POINT connections always list the point first.
+        if isinstance(contact, Line) and connectionType == SIDE_POINT:
+            touching.reverse()
+        self.touching = touching
+        if locationNumbers is not None:
+            self.locationNumbers = list(locationNumbers)
+            return
+        #Retrieve and store location numbers.
+        self.locationNumbers = [
+            self.pieces[0].getLocationNumber(contact),
+            self.pieces[1].getLocationNumber(otherContact)
+        ]
+
     #Draws the connection to the given image.
     def draw(self, img):
         drawColors = {
@@ -176,7 +197,9 @@ class Connection:
         string += "\t" + str(piece2) + '\n'
         return string
 
-class Point:
+class Point(object):
+    __slots__ = ("pt",)
+
     def __init__(self, pt):
         self.pt = pt
 
@@ -187,15 +210,21 @@ class Point:
     def __str__(self):
         return str( np.asarray(self.pt) )
 
-class Line:
-    def __init__(self,pts):
+class Line(object):
+    __slots__ = ("pts", "length", "center", "slope")
+
+    #Piece passes in the length, center and slope it already computed for
+    #all of its sides at once.
+    def __init__(self, pts, length = None, center = None, slope = None):
         self.pts = pts
         pt1, pt2 = pts
-        self.length = dist(pt1, pt2)
-        self.center = (pt1 + pt2) / 2
-        dx = pt2[0] - pt1[0]
-        dy = pt2[1] - pt1[1]
-        self.slope = np.arctan((pt2[1] - pt1[1]) / (pt2[0] - pt1[0]))
+        if length is None:
+            length = dist(pt1, pt2)
+            center = (pt1 + pt2) / 2
+            slope = np.arctan((pt2[1] - pt1[1]) / (pt2[0] - pt1[0]))
+        self.length = length
+        self.center = center
+        self.slope = slope
 
     #Returns true if the two lines are parallel.
     def isParallel(self, otherLine):
@@ -218,16 +247,52 @@ class Line:
     def __str__(self):
         return str( np.asarray(self.pts))
 
-class Piece:
+class Piece(object):
+    __slots__ = ("contour", "center", "vertices", "sideLengths",
+                 "sideCenters", "sideSlopes", "sides", "name", "trackId",
+                 "hasSymmetry", "theta", "spin", "rcIndex", "symmetrySkip",
+                 "symmetryPattern", "contourSideLengths", "cornerAngles",
+                 "vertexAngles", "sideLocations", "vertexLocations")
 
-    def __init__(self, contour):
+    def __init__(self, contour, center = None, shape = None):
+        """ NOTES
+            center and shape may be given when they are already known, shape
+            being the (name, theta, spin, rcIndex) classifyContours found
+            for the contour. Otherwise they are found here.
+            """
         self.contour = contour
-        self.center = getCenter(contour)
-        fCont = np.float32(contour)
-        self.sides = [Line([fCont[i][0], fCont[(i + 1) % len(contour)][0]])
+        if center is None:
+            center = getCenter(contour)
+        self.center = center
+        #Vertices and side data as contiguous float32 arrays, side i going
+        #from vertex i to vertex i + 1. Each Line is a view into them.
+        self.vertices = np.float32(contour).reshape(-1, 2)
+        ends = np.concatenate((self.vertices[1:], self.vertices[:1]))
+        offsets = ends - self.vertices
+        self.sideLengths = np.sqrt((offsets * offsets).sum(axis=1))
+        self.sideCenters = (self.vertices + ends) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.sideSlopes = np.arctan(offsets[:, 1] / offsets[:, 0])
+        self.sides = [Line([self.vertices[i], ends[i]], self.sideLengths[i],
+                           self.sideCenters[i], self.sideSlopes[i])
                      for i in range(len(contour))]
+        self.findSideLengthsAndAngles()
 
         self.name = "NON_PIECE"
+        #Stable id across frames, given by TangramsTracker.PieceTracker.
+        self.trackId = None
+        self.hasSymmetry = False
+        self.theta = None
+        self.spin = None
+        self.rcIndex = None
+        self.symmetrySkip = None
+        self.symmetryPattern = None
+
+        if shape is not None:
+            self.name, self.theta, self.spin, self.rcIndex = shape
+            self.hasSymmetry = self.name in ('square', 'parallelogram')
+            self.findLocationNumbers()
+            return
 
         #Determines the name of the piece.
         if (len(contour) == 4):
@@ -242,8 +307,68 @@ class Piece:
                 self.name = 'triangle'
                 self.hasSymmetry = False
 
-        if "name" in self.__dict__:
-            self.theta = self.findAngleFromXaxis()
+        self.theta = self.findAngleFromXaxis()
+        self.findLocationNumbers()
+
+    #Computes the side lengths and vertex angles of the contour once, for
+    #every vertex at the same time.
+    def findSideLengthsAndAngles(self):
+        self.contourSideLengths, angles = polygonSidesAndAngles(
+            self.contour.reshape(-1, 2))
+        self.cornerAngles = angles
+
+        #getIndexOfVertex finds the first of any repeated vertices, so the
+        #angle of a vertex is the angle of its first copy.
+        self.vertexAngles = angles[self.getIndexOfVertex(self.contour)]
+
+    #Precomputes the location number of every side and every vertex.
+    def findLocationNumbers(self):
+        count = len(self.contour)
+        ### SQUARE ###
+        if self.name == 'square':
+            #-1 because which side or point doesn't matter on a square.
+            self.sideLocations = [-1] * count
+            self.vertexLocations = [-1] * count
+        ### PARALLELOGRAM ###
+        elif self.name == 'parallelogram':
+            #Sides as long as one of the two shortest are 1, others 2.
+            #Side lengths are compared at the float32 precision of Line.
+            shortest = np.sort(self.contourSideLengths)[:2]
+            sides = np.where((self.sideLengths.astype(np.float64)[:, None]
+                              == shortest[None, :]).any(axis=1), 1, 2)
+            #Vertices with one of the two smallest angles are 1, others 2.
+            smallest = np.sort(self.vertexAngles)[:2]
+            vertices = np.where((self.vertexAngles[:, None]
+                                 == smallest[None, :]).any(axis=1), 1, 2)
+            #Numbers for CW, CCW ones are 2 higher.
+            if self.spin != "CW":
+                sides += 2
+                vertices += 2
+            self.sideLocations = sides.tolist()
+            self.vertexLocations = vertices.tolist()
+        ### TRIANGLE ###
+        elif self.name == 'triangle':
+            #The longest side is 1, the side after it 2 and the last one 3.
+            lengths = self.contourSideLengths
+            largestSideIndex = lengths.argmax()
+            #Mod 3 to loop around triangle if out of bounds.
+            largestSideNeighborIndex = (largestSideIndex + 1) % 3
+            sideLengths = self.sideLengths.astype(np.float64)
+            sides = np.where(sideLengths == lengths[largestSideIndex], 1,
+                np.where(sideLengths == lengths[largestSideNeighborIndex],
+                         2, 3))
+            #The right angled vertex is 1, the vertex after it 2 and the
+            #last one 3. Repeated vertices use their first copy.
+            first = self.getIndexOfVertex(self.contour)
+            #TODO Maybe go and make an AngleCloseEnough Function?
+            isRight = np.abs(0.5 * np.pi - self.vertexAngles) < MAX_ANG_DIFF
+            vertices = np.where(isRight[first], 1,
+                                np.where(isRight[(first + 1) % 3], 2, 3))
+            self.sideLocations = sides.tolist()
+            self.vertexLocations = vertices.tolist()
+        else:
+            self.sideLocations = [None] * count
+            self.vertexLocations = [None] * count
 
     #Finds the angle form the x - axis.
     def findAngleFromXaxis(self):
@@ -324,7 +449,7 @@ class Piece:
     def draw(self, img):
         cv2.drawContours(img, [self.contour], -1, (125, 0, 0), 1)
 
-        if "theta" in self.__dict__ and self.theta != None:
+        if self.theta is not None:
             cx, cy = self.center
 
             color = (0, 0, 255)
@@ -351,112 +476,40 @@ class Piece:
         return string
 
     def getAngleAtVertex(self, vertex):
-        vertexIndex = self.getIndexOfVertex(vertex)
-        #Get neighbors' index.
-        previousNeighbor = (vertexIndex - 1) % len(self.contour)
-        nextNeighbor = (vertexIndex + 1) % len(self.contour)
-        #Get vectors to neighbors.
-        toPreviousNeighbor = (self.contour[previousNeighbor] - vertex)[0];
-        toNextNeighbor = (self.contour[nextNeighbor] - vertex)[0];
-        #Return angle between neighbors.
-        return angleBetween(toPreviousNeighbor, toNextNeighbor)
+        return self.vertexAngles[self.getIndexOfVertex(vertex)]
 
+    #Returns the index of the first copy of the vertex in the contour, or
+    #None. Also takes an array of vertices and returns an array of indexes.
     def getIndexOfVertex(self, vertex):
-        for i in range(len(self.contour)):
-            if all( (self.contour[i] == vertex)[0]):
+        points = self.contour.reshape(-1, 2)
+        vertices = np.reshape(vertex, (-1, 2))
+        matches = (vertices[:, None, :] == points[None, :, :]).all(axis=2)
+        if np.ndim(vertex) == 3:
+            return matches.argmax(axis=1)
+        if matches.any():
+            return matches.argmax()
+
+    def getIndexOfSide(self, side):
+        for i in range(len(self.sides)):
+            if self.sides[i] is side:
                 return i
+        raise ValueError('The side is not a side of this piece.')
 
+    #Returns the location number of the given side or contour point of this
+    #piece. These are looked up, findLocationNumbers works them out.
     def getLocationNumber(self, contact):
-        ### SQUARE ###
-        if self.name == 'square':
-            # print "getting locationNumbers of square"
-            #Returns -1 because which point doesn't matter on a square.
-            return -1
-        ### PARALLELOGRAM ###
-        elif self.name == 'parallelogram':
-            # print "getting locationNumbers of parallelogram"
-            return self.getLocationNumberOfParallelogram(contact)
-        ### TRIANGLE ###
-        elif self.name == 'triangle':
-            # print "getting locationNumbers of triangle"
-            return self.getLocationNumberOfTriangle(contact)
-    
-    def getLocationNumberOfParallelogram(self, contact):
-        locationNum = None
-        
-        if(isinstance(contact, Line)):
-            #Calculate line Nums for CW
-            sideLengths = self.getSideLengths()
-            sideLengths.sort()
-
-            if( contact.length in sideLengths[:2] ):
-                locationNum = 1
-            else:
-                locationNum = 2
-
-            if self.spin != "CW":
-                locationNum += 2
-
-            return locationNum
-        else:
-            #Calculate point Nums for CW
-            vertexAngles = self.getVertexAngles()
-            vertexAngles.sort()
-            contactAngle = self.getAngleAtVertex(contact)
-
-            if( contactAngle in vertexAngles[:2] ):
-                locationNum = 1
-            else:
-                locationNum = 2
-
-            if self.spin != "CW":
-                locationNum += 2
-
-            return locationNum
-
-    def getLocationNumberOfTriangle(self, contact):
         if(isinstance(contact, Line)):
-            #Calculate line NUMS for Triangle
-            sideLengths = self.getSideLengths()
-            largestSideIndex = sideLengths.index(max(sideLengths))
-            #Mod 3 to loop around triangle if out of bounds.
-            largesstSideNeighborIndex = (largestSideIndex + 1) % 3;
-            if(contact.length == sideLengths[largestSideIndex]):
-                return 1
-            elif(contact.length == sideLengths[largesstSideNeighborIndex]):
-                return 2
-            else:
-                return 3
-
+            return self.sideLocations[self.getIndexOfSide(contact)]
         else:
-            #Calculate point NUMS for Triangle
-            vertexIndex = self.getIndexOfVertex(contact)
-            #Mod 3 to loop around the triangle if index gets too large.
-            nextVertexIndex = (vertexIndex + 1) % 3
-            vertexAngles = self.getVertexAngles()
-            #TODO Maybe go and make an AngleCloseEnough Function?
-            if(abs(0.5*np.pi - vertexAngles[vertexIndex]) < MAX_ANG_DIFF):
-                return 1
-            elif(abs(0.5*np.pi-vertexAngles[nextVertexIndex]) < MAX_ANG_DIFF):
-                return 2
-            else:
-                return 3
+            return self.vertexLocations[self.getIndexOfVertex(contact)]
 
+    #Returns a list of the angles at each vertex.
     def getVertexAngles(self):
-        vertexAngles = []
-        for i in range(len(self.contour)):
-            angle = self.getAngleAtVertex(self.contour[i])
-            vertexAngles.append(angle)
-        return vertexAngles
+        return list(self.vertexAngles)
 
     #Returns a list of lengths of each side of the given contour.
     def getSideLengths(self):
-        sideLengths = []
-        for i in range(len(self.contour)):
-            length = dist(self.contour[i],
-                          self.contour[(i + 1) % len(self.contour)])
-            sideLengths.append(length)
-        return sideLengths
+        return list(self.contourSideLengths)
 
     #Decides if a contour is a Right angle Isosceles
     def isRightIsosceles(self):
@@ -475,31 +528,20 @@ class Piece:
     def isSquare(self):
         if len(self.contour) != 4:
             return False
-        for i in range(4):
-            #Pick three corners.
-            p1 = (self.contour[i])
-            p2 = (self.contour[(i + 1) % 4])
-            p3 = (self.contour[(i + 2) % 4])
-            #Find lengths of sides.
-            l1 = dist(p1, p2)
-            l2 = dist(p2, p3)
-            #Vectors from middle point to neighbors.
-            v1 = np.subtract(p2, p1)
-            v2 = np.subtract(p2, p3)
-            theta = angleBetween(v1[0], v2[0])
-            if abs(l2 - l1) > .1 * l1 and abs(theta - np.pi / 2) > 0.1:
-                return False
-        return True
+        #Side i and side i + 1 meet at corner i + 1.
+        l1 = self.contourSideLengths
+        l2 = np.roll(l1, -1)
+        theta = np.roll(self.cornerAngles, -1)
+        notSquare = ((np.abs(l2 - l1) > .1 * l1)
+                   & (np.abs(theta - np.pi / 2) > 0.1))
+        return not notSquare.any()
 
     #Decides if the piece is a parallelogram.
     def isParallelogram(self):
         #Makes the assumptions of 4 sides and not a square.
-        aLen = self.getSideLengths()
-        for i in range(2):
-            d = abs(aLen[i] - aLen[i + 2])
-            if d > 0.1 * aLen[i]:
-                return False
-        return True
+        aLen = self.contourSideLengths
+        d = np.abs(aLen[:2] - aLen[2:])
+        return not (d > 0.1 * aLen[:2]).any()
 
     def indentifySymmetry(self, connections):
         """ NOTES
@@ -533,70 +575,570 @@ def drawLines(img, pieces):
     for piece in pieces:
         for side in piece.sides[:1]:
             side.draw(img)
-    centers = []
-    valid = []
-    #SOMETHING HERE IS WRONG NOT SURE WHAT
-    for cont in contours:
-        if len(centers) > 0:
-            center = getCenter(cont)
-            distances = [dist(np.asarray(i),np.asarray(center)) for i in centers]
-            #print distances
-            smallest = min(distances)
-            if smallest > 20:
-                valid.append(cont)
-                centers.append(center)
-        else:
-            valid.append(cont)
-            centers.append(getCenter(cont))
-            #print centers, "***"
-    #print centers
-    #print ""
-    return valid
 
 #Returns the valid connections between the given pieces.
-def findConnections(pieces):
+#vectorized selects the batched engine, otherwise every candidate pair runs
+#Connection.determineConnectionType. Both give the same connections.
+#spatialIndex finds the candidate pairs with a PieceGrid instead of checking
+#every pair of pieces. cache is an optional ConnectionCache that remembers
+#the connections of pairs from earlier frames.
+@instrument("findConnections", "connections")
+def findConnections(pieces, vectorized = True, spatialIndex = False,
+                    cache = None):
+    first, second = findCandidatePairs(pieces, spatialIndex)
+    if cache is not None:
+        return cache.connectPairs(pieces, first, second, vectorized)
+    return connectPairs(pieces, first, second, vectorized)
+
+#Returns the connections between pieces[first[m]] and pieces[second[m]],
+#found with either engine.
+def connectPairs(pieces, first, second, vectorized = True):
+    if vectorized:
+        return determineConnectionTypes(pieces, first, second)
     connections = []
-    if len( pieces) > 1:
-        for i in range(len(pieces) - 1):
-            for other in pieces[i + 1:]:
-                center1 = np.asarray(pieces[i].center)
-                center2 = np.asarray(other.center)
-                d = dist(center1, center2)
-                if d < MAX_CONNECTION_DIST:
-                    connections.append(Connection(pieces[i], other))
+    for i, j in zip(first, second):
+        connections.append(Connection(pieces[i], pieces[j]))
     #Remove non-connections from list
     connections = [i for i in connections if i.connectionType != NON_CONNECTION]
     return connections
 
+#Returns the indexes (first, second) of the pairs of pieces whose centers are
+#closer than MAX_CONNECTION_DIST, ordered by first then second. With
+#spatialIndex, pairs that are too far apart to touch are dropped as well.
+def findCandidatePairs(pieces, spatialIndex = False):
+    if len(pieces) < 2:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    if spatialIndex:
+        return PieceGrid(pieces).candidatePairs()
+    centers = np.asarray([piece.center for piece in pieces])
+    first, second = np.triu_indices(len(pieces), 1)
+    offsets = centers[first] - centers[second]
+    near = np.sqrt((offsets * offsets).sum(axis=1)) < MAX_CONNECTION_DIST
+    return first[near], second[near]
+
+#Uniform grid over the piece centers with cells MAX_CONNECTION_DIST wide, so
+#only pieces in neighboring cells need to be compared.
+class PieceGrid:
+
+    def __init__(self, pieces, cellSize = MAX_CONNECTION_DIST):
+        self.cellSize = float(cellSize)
+        self.centers = np.asarray([piece.center for piece in pieces])
+        #Bounding boxes as x1, y1, x2, y2 grown by the largest distance any
+        #contact test allows, so boxes that don't overlap can't connect.
+        margin = max(MAX_POINT_POINT_DIST, MAX_POINT_SIDE_DIST,
+                     MAX_CENTER_DIST)
+        self.boxes = np.zeros((len(pieces), 4))
+        for n, piece in enumerate(pieces):
+            x, y, w, h = cv2.boundingRect(piece.contour)
+            self.boxes[n] = [x - margin, y - margin,
+                             x + w + margin, y + h + margin]
+
+        #Cell coordinates, shifted so the neighbors of every cell are >= 0.
+        self.keys = np.floor(self.centers / self.cellSize).astype(int)
+        self.keys -= self.keys.min(axis=0) - 1
+        self.rows = self.keys[:, 1].max() + 2
+        #Pieces sorted by cell so each cell is a slice of self.order.
+        self.cellIds = self.cellId(self.keys)
+        self.order = np.argsort(self.cellIds, kind='mergesort')
+        self.sortedIds = self.cellIds[self.order]
+
+    def cellId(self, keys):
+        return keys[:, 0] * self.rows + keys[:, 1]
+
+    #Returns the indexes (pieces, others) of every piece paired with every
+    #piece in the neighboring cell at the given offset.
+    def neighbors(self, offset):
+        ids = self.cellId(self.keys + offset)
+        starts = np.searchsorted(self.sortedIds, ids, 'left')
+        counts = np.searchsorted(self.sortedIds, ids, 'right') - starts
+        pieces = np.repeat(np.arange(len(ids)), counts)
+        #Position of each pair within its cell's slice.
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                     counts)
+        others = self.order[np.repeat(starts, counts) + within]
+        return pieces, others
+
+    #Returns the pairs of the brute force search in findCandidatePairs that
+    #could touch, in the same order.
+    def candidatePairs(self):
+        first = []
+        second = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                i, j = self.neighbors([dx, dy])
+                keep = j > i
+                first.append(i[keep])
+                second.append(j[keep])
+        first = np.concatenate(first)
+        second = np.concatenate(second)
+
+        offsets = self.centers[first] - self.centers[second]
+        near = np.sqrt((offsets * offsets).sum(axis=1)) < MAX_CONNECTION_DIST
+        box1 = self.boxes[first]
+        box2 = self.boxes[second]
+        overlap = ((box2[:, 0] <= box1[:, 2]) & (box2[:, 2] >= box1[:, 0])
+                 & (box2[:, 1] <= box1[:, 3]) & (box2[:, 3] >= box1[:, 1]))
+        first = first[near & overlap]
+        second = second[near & overlap]
+        order = np.lexsort((second, first))
+        return first[order], second[order]
+
+#LRU cache of the connections between pairs of pieces by their relative
+#pose, so pairs that look the same as in an earlier frame skip the tests.
+class ConnectionCache:
+
+    def __init__(self, maxSize = CONNECTION_CACHE_SIZE,
+                 quantum = CONNECTION_CACHE_QUANTUM):
+        """ NOTES
+            A pair's key is the names of its pieces, the offset between their
+            centers and the vertices of each piece from its own center, all
+            rounded to quantum pixels. The vertices stand in for theta: they
+            fix the rotation and size of NON_PIECEs too, and the order of the
+            sides and corners the cached contacts point at. Pairs that
+            differ by less than the quantum share a result, so with a quantum
+            of a pixel or more a pair right at the limit of a test may get
+            the result of a nearby pose.
+            Non-connections are cached as well. Once more than maxSize pairs
+            are kept, the least recently used tenth is dropped at once, which
+            is cheaper than keeping the pairs in order on every lookup. None
+            keeps every pair.
+            """
+        self.maxSize = maxSize
+        self.quantum = float(quantum)
+        #key -> [last call it was used in, value]. value is None for a
+        #non-connection, else (connectionType, contacts, locationNumbers)
+        #with contacts from connectionContacts.
+        self.entries = {}
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    #Returns the connections between pieces[first[m]] and pieces[second[m]],
+    #like connectPairs, running the tests only for pairs not in the cache.
+    def connectPairs(self, pieces, first, second, vectorized = True):
+        if len(first) == 0:
+            return []
+        self.calls += 1
+        keys = self.pairKeys(pieces, first, second)
+        missing = []
+        #Pair index -> connection, for the pairs that connect.
+        found = {}
+        for m, key in enumerate(keys):
+            entry = self.entries.get(key)
+            if entry is None:
+                missing.append(m)
+                continue
+            entry[0] = self.calls
+            if entry[1] is not None:
+                connectionType, contacts, locationNumbers = entry[1]
+                piece1 = pieces[first[m]]
+                piece2 = pieces[second[m]]
+                connection = Connection(piece1, piece2, False)
+                connection.setContacts(connectionType,
+                                       contactOf(piece1, contacts[0]),
+                                       contactOf(piece2, contacts[1]),
+                                       locationNumbers)
+                found[m] = connection
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            missing = np.asarray(missing)
+            computed = connectPairs(pieces, first[missing], second[missing],
+                                    vectorized)
+            byPair = dict(((id(connection.pieces[0]), id(connection.pieces[1])),
+                           connection) for connection in computed)
+            for m in missing.tolist():
+                connection = byPair.get((id(pieces[first[m]]),
+                                         id(pieces[second[m]])))
+                value = None
+                if connection is not None:
+                    found[m] = connection
+                    value = (connection.connectionType,
+                             connectionContacts(connection),
+                             list(connection.locationNumbers))
+                self.store(keys[m], value)
+        return [found[m] for m in sorted(found)]
+
+    #Returns the cache keys of the pairs.
+    def pairKeys(self, pieces, first, second):
+        shapes = {}
+        for i in set(first.tolist()) | set(second.tolist()):
+            piece = pieces[i]
+            offsets = (piece.vertices - piece.center) / self.quantum
+            shapes[i] = (piece.name,
+                         tuple(np.round(offsets).astype(int).ravel().tolist()))
+        centers = np.asarray([piece.center for piece in pieces])
+        offsets = np.round((centers[second] - centers[first])
+                           / self.quantum).astype(int).tolist()
+        return [(shapes[i], shapes[j], dx, dy) for i, j, (dx, dy)
+                in zip(first.tolist(), second.tolist(), offsets)]
+
+    def store(self, key, value):
+        if self.maxSize is not None and self.maxSize <= 0:
+            return
+        self.entries[key] = [self.calls, value]
+        if self.maxSize is not None and len(self.entries) > self.maxSize:
+            self.evict(self.maxSize - self.maxSize // 10)
+
+    #Drops the least recently used pairs until size are left.
+    def evict(self, size):
+        byUse = sorted(self.entries, key=lambda key: self.entries[key][0])
+        for key in byUse[:len(self.entries) - size]:
+            del self.entries[key]
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    #Fraction of the pairs looked up that were in the cache.
+    def hitRate(self):
+        return self.hits / float(max(self.hits + self.misses, 1))
+
+    def report(self):
+        print("Connection cache: %d hits, %d misses (%.1f%%), %d pairs kept, "
+              "%d evicted" % (self.hits, self.misses, 100 * self.hitRate(),
+                              len(self.entries), self.evictions))
+
+#Contour points and side data of a list of pieces, padded to the size of the
+#largest piece so they can be broadcast against each other.
+class PieceGeometry:
+
+    def __init__(self, pieces):
+        count = len(pieces)
+        size = max(len(piece.contour) for piece in pieces)
+        self.size = size
+        self.points = np.zeros((count, size, 2))
+        self.valid = np.zeros((count, size), dtype=bool)
+        #Side i goes from point i to point i + 1.
+        self.starts = np.zeros((count, size, 2))
+        self.ends = np.zeros((count, size, 2))
+        self.centers = np.zeros((count, size, 2))
+        self.lengths = np.ones((count, size), dtype=np.float32)
+        self.slopes = np.zeros((count, size), dtype=np.float32)
+
+        for n, piece in enumerate(pieces):
+            k = len(piece.vertices)
+            self.points[n, :k] = piece.vertices
+            self.valid[n, :k] = True
+            self.starts[n, :k] = piece.vertices
+            self.ends[n, :k] = [side.pts[1] for side in piece.sides]
+            self.centers[n, :k] = piece.sideCenters
+            self.lengths[n, :k] = piece.sideLengths
+            self.slopes[n, :k] = piece.sideSlopes
+
+#Returns the distances from each side to each target as an array of shape
+#(pairs, sides, targets). Same as Line.distanceTo.
+def sideDistances(starts, ends, lengths, targets):
+    direction = (ends - starts)[:, :, None, :]
+    toTarget = targets[:, None, :, :] - starts[:, :, None, :]
+    cross = (direction[..., 0] * toTarget[..., 1]
+             - direction[..., 1] * toTarget[..., 0])
+    return np.abs(cross) / lengths[:, :, None]
+
+#Returns the distances between each a and each b as (pairs, a, b).
+def pairDistances(a, b):
+    offsets = a[:, :, None, :] - b[:, None, :, :]
+    return np.sqrt((offsets * offsets).sum(axis=3))
+
+#Returns the connections between pieces[first[m]] and pieces[second[m]].
+#Runs the same tests, in the same order, as determineConnectionType.
+def determineConnectionTypes(pieces, first, second):
+    if len(first) == 0:
+        return []
+    g = PieceGeometry(pieces)
+    size = g.size
+    valid = g.valid[first][:, :, None] & g.valid[second][:, None, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #[m, i, j] is side i of the first piece against side j of the second.
+        parallel = np.abs(g.slopes[first][:, :, None]
+                          - g.slopes[second][:, None, :]) < 0.15
+        sideSide = (parallel
+            & (sideDistances(g.starts[first], g.ends[first],
+                g.lengths[first], g.centers[second]) < MAX_SIDE_CENTER_DIST)
+            & (sideDistances(g.starts[second], g.ends[second],
+                g.lengths[second], g.centers[first]).transpose(0, 2, 1)
+                < MAX_SIDE_CENTER_DIST)
+            & (pairDistances(g.centers[first], g.centers[second])
+                < MAX_CENTER_DIST)
+            & valid)
+
+        #[m, i, j] is side i of the first piece against point j of the second.
+        sidePoint = ((sideDistances(g.starts[first], g.ends[first],
+                g.lengths[first], g.points[second]) < MAX_POINT_SIDE_DIST)
+            & (pairDistances(g.centers[first], g.points[second])
+                < g.lengths[first][:, :, None] / 2.0)
+            & valid)
+
+        #[m, i, j] is point i of the first piece against point j of the second.
+        pointPoint = ((pairDistances(g.points[first], g.points[second])
+                < MAX_POINT_POINT_DIST)
+            & valid)
+
+        #[m, i, j] is point i of the first piece against side j of the second.
+        pointSide = ((sideDistances(g.starts[second], g.ends[second],
+                g.lengths[second], g.points[first]).transpose(0, 2, 1)
+                < MAX_POINT_SIDE_DIST)
+            & (pairDistances(g.points[first], g.centers[second])
+                < g.lengths[second][:, None, :] / 2.0)
+            & valid)
+
+    #Laid out in the order determineConnectionType looks at them, so the
+    #first true entry of each row is the connection it would have found.
+    sideTests = np.concatenate((sideSide, sidePoint), axis=2)
+    pointTests = np.concatenate((pointPoint, pointSide), axis=2)
+    sideTests = sideTests.reshape(len(first), -1)
+    pointTests = pointTests.reshape(len(first), -1)
+    sideFound = sideTests.any(axis=1)
+    pointFound = pointTests.any(axis=1)
+    sideIndexes = sideTests.argmax(axis=1)
+    pointIndexes = pointTests.argmax(axis=1)
+
+    connections = []
+    for m in range(len(first)):
+        if not (sideFound[m] or pointFound[m]):
+            continue
+        piece1 = pieces[first[m]]
+        piece2 = pieces[second[m]]
+        connection = Connection(piece1, piece2, False)
+        if sideFound[m]:
+            i, j = divmod(sideIndexes[m], 2 * size)
+            if j < size:
+                connection.setContacts(SIDE_SIDE, piece1.sides[i],
+                                       piece2.sides[j])
+            else:
+                connection.setContacts(SIDE_POINT, piece1.sides[i],
+                                       piece2.contour[j - size])
+        else:
+            i, j = divmod(pointIndexes[m], 2 * size)
+            if j < size:
+                connection.setContacts(POINT_POINT, piece1.contour[i],
+                                       piece2.contour[j])
+            else:
+                connection.setContacts(SIDE_POINT, piece1.contour[i],
+                                       piece2.sides[j - size])
+        connections.append(connection)
+    return connections
+
+#Returns the contacts of the first and second piece of the connection, each
+#the index of a side with SIDE_CONTACT set or of a contour point.
+#vertexIndexes optionally maps id(piece) to {vertex: index of its first copy}
+#so points are found without searching the contour.
+def connectionContacts(connection, vertexIndexes = None):
+    pieces = connection.pieces
+    touching = list(connection.touching)
+    #setContacts lists the point of a SIDE_POINT connection first, even when
+    #it is on the second piece.
+    if any(side is touching[1] for side in pieces[0].sides):
+        touching.reverse()
+    contacts = []
+    for piece, contact in zip(pieces, touching):
+        if isinstance(contact, Line):
+            contacts.append(piece.getIndexOfSide(contact) | SIDE_CONTACT)
+        elif vertexIndexes is not None:
+            vertex = tuple(contact.pt.ravel().tolist())
+            contacts.append(vertexIndexes[id(piece)][vertex])
+        else:
+            contacts.append(int(piece.getIndexOfVertex(contact.pt)))
+    return contacts
+
+#Returns the side or contour point of the piece a contact stands for.
+def contactOf(piece, contact):
+    contact = int(contact)
+    if contact & SIDE_CONTACT:
+        return piece.sides[contact & ~SIDE_CONTACT]
+    return piece.contour[contact]
+
 def indentifySymmetry(pieces, connections):
     for piece in pieces:
         if piece.hasSymmetry:
             piece.indentifySymmetry(connections)
 
 #Returns a list of contours from given image that should be pieces.
-def findValid(img):
-    #Upper and lower bounds for the colors of the pieces.
-    high, low = getColors(img)
+#colorTable is an optional TangramsColors.ColorTable used to label the
+#colors instead of the getColors ranges.
+#debug is an optional sink called as debug(name, image) with each color's
+#mask, for example cv2.imshow or an ImageCollector. By default no GUI work
+#is done.
+@instrument("findValid", "contours")
+def findValid(img, colorTable = None, debug = None):
+    #Every color is labeled in one pass, then split back into masks.
+    label, colorNames = makeLabeler(img, colorTable)
+    labels = label(img)
 
     valid = []
-    blur = cv2.blur(img, (10, 10))
-    for color in high.keys():
-        lower = np.array(low[color])
-        upper = np.array(high[color])
-
-        #shapeMask of pixels that fit current criteria.
-        shapeMask = cv2.inRange(img, lower, upper)
-        
-        cv2.imshow(color, shapeMask)
-
-        ret, thresh = cv2.threshold(shapeMask, 127, 255, 0)
-        _, contours, _ = cv2.findContours(thresh, cv2.RETR_TREE,
-                                         cv2.CHAIN_APPROX_SIMPLE)
-        contours = reduceToBlocks(contours)
-        for cont in contours:
+    for bit, color in enumerate(colorNames):
+        for cont in findBlocks(labels, bit, color, debug):
             valid.append(cont)
-    #valid = removeDuplicates(valid)
-    return valid
+    return removeDuplicates(valid)
+
+#Same as findValid, but the frame is segmented at 1 / 2 ** levels of its size
+#and the contours are then refined at full resolution.
+@instrument("findValidPyramid", "contours")
+def findValidPyramid(img, levels = 1, colorTable = None, debug = None,
+                     refine = True):
+    """ NOTES
+        Labeling, thresholding and findContours run on the downscaled frame,
+        with the area limits of reduceToBlocks scaled to match. With refine,
+        the frame is then segmented again at full resolution only in windows
+        around the coarse blocks, see refineBlocks. Without it the scaled up
+        coarse contours are returned.
+
+        The contours are in full resolution pixels either way, so the
+        connection distances like MAX_POINT_POINT_DIST keep their meaning
+        and don't depend on levels.
+
+        With refine, levels 1 and 2 give the same contours as findValid on
+        the images in Images/. At level 3 a block of only a few hundred
+        pixels is under two pixels across when downscaled, so it isn't
+        found at all and can't be refined.
+        """
+    factor = 2 ** levels
+    #cv2 has a fast path for halving with INTER_AREA, but not for 1 / 4.
+    small = img
+    for level in range(levels):
+        small = cv2.resize(small, (small.shape[1] // 2, small.shape[0] // 2),
+                           interpolation=cv2.INTER_AREA)
+    label, colorNames = makeLabeler(img, colorTable)
+    labels = label(small)
+
+    #Touching pieces merged by downscaling aren't 3 or 4 sided, so any
+    #polygon is a candidate when it is refined. Blocks near the smallest
+    #area lose more of it to downscaling, so smaller candidates are kept
+    #too and the full resolution pass applies the real limit.
+    vertexCounts = (3, 4)
+    minAreaScale = None
+    if refine:
+        vertexCounts = None
+        minAreaScale = REFINE_MIN_AREA / factor ** 2
+
+    coarse = []
+    for bit, color in enumerate(colorNames):
+        for cont in findBlocks(labels, bit, color, debug, 1.0 / factor ** 2,
+                               vertexCounts, minAreaScale):
+            #Center of the full resolution pixels under each small pixel.
+            coarse.append((bit, np.int32(cont * factor + (factor - 1) // 2)))
+    if not refine:
+        return [cont for bit, cont in coarse]
+    return refineBlocks(img, coarse, label, REFINE_MARGIN * factor)
+
+#Returns the full resolution blocks that overlap the coarse (bit, contour)
+#blocks of the same color, in the order findValid would give them.
+@instrument("refineBlocks")
+def refineBlocks(img, coarse, label, margin):
+    """ NOTES
+        The windows around the coarse blocks, margin pixels larger, are
+        merged so each pixel is labeled once for every color. A block cut by
+        the edge of its window grows the window and the windows are searched
+        again, up to REFINE_GROWTH times. Pieces that touch merge into one
+        block more easily when downscaled, so one coarse block may give
+        several full resolution blocks.
+
+        A block is kept when its convex hull intersects the hull of a
+        coarse block, not only when its center is inside one. Thin blocks
+        shift by more than their width when downscaled, and their centers
+        can fall outside the coarse polygon they came from.
+        """
+    height, width = img.shape[:2]
+    regions = clipRects(mergeRects([growRect(cv2.boundingRect(cont), margin)
+                                    for bit, cont in coarse]), width, height)
+    for attempt in range(REFINE_GROWTH):
+        found = []
+        grown = []
+        for rect in regions:
+            x, y, w, h = rect
+            labels = label(img[y:y + h, x:x + w])
+            for bit in sorted(set(bit for bit, cont in coarse)):
+                inside = [np.float32(cv2.convexHull(cont))
+                          for b, cont in coarse if b == bit
+                          and rectsOverlap(cv2.boundingRect(cont), rect)]
+                if len(inside) == 0:
+                    continue
+                for block in findBlocks(labels, bit):
+                    block = block + np.int32([x, y])
+                    hull = np.float32(cv2.convexHull(block))
+                    if not any(cv2.intersectConvexConvex(hull, cont)[0] > 0
+                               for cont in inside):
+                        continue
+                    if touchesEdge(block, rect, width, height):
+                        rect = unionRect(rect, growRect(
+                            cv2.boundingRect(block), margin))
+                    found.append((bit, block))
+            grown.append(rect)
+        if grown == regions:
+            break
+        regions = clipRects(mergeRects(grown), width, height)
+    found.sort(key=lambda item: item[0])
+    return removeDuplicates([block for bit, block in found])
+
+#Returns a function that gives the label image of img, or of any part of it,
+#and the color name of each bit in the labels.
+def makeLabeler(img, colorTable = None):
+    if colorTable is None:
+        #Upper and lower bounds for the colors of the pieces.
+        high, low = getColors(img)
+        colorNames = list(high.keys())
+        table = colorLookupTable(high, low, colorNames)
+        label = lambda part: labelWithLookup(part, table)
+    else:
+        colorNames = colorTable.colorNames
+        label = lambda part: colorTable.classify(colorTable.convert(part))
+    return instrument("label")(label), colorNames
+
+#Returns the contours of the blocks of color bit in the label image.
+@instrument("findBlocks")
+def findBlocks(labels, bit, color = None, debug = None, areaScale = 1.0,
+               vertexCounts = (3, 4), minAreaScale = None):
+    #shapeMask of pixels that fit current criteria.
+    shapeMask = np.bitwise_and(labels, 1 << bit)
+    ret, shapeMask = cv2.threshold(shapeMask, 0, 255, cv2.THRESH_BINARY)
+
+    if debug is not None:
+        debug(color, shapeMask)
+
+    _, contours, _ = cv2.findContours(shapeMask, cv2.RETR_TREE,
+                                     cv2.CHAIN_APPROX_SIMPLE)
+    return reduceToBlocks(contours, areaScale, vertexCounts, minAreaScale)
+
+#Debug sink that keeps a copy of the latest image given under each name.
+class ImageCollector:
+
+    def __init__(self):
+        self.images = {}
+
+    def __call__(self, name, img):
+        self.images[name] = img.copy()
+
+    #Shows every collected image in its own window.
+    def show(self):
+        for name in self.images:
+            cv2.imshow(name, self.images[name])
+
+#Returns a label image where bit n of each pixel is set if the pixel is
+#within the bounds of the color colorNames[n], the same test as cv2.inRange.
+#The ranges are per channel, so one lookup table per channel and an and of
+#the three results labels every color at once. Colors may overlap.
+def labelColors(img, high, low, colorNames):
+    return labelWithLookup(img, colorLookupTable(high, low, colorNames))
+
+#Returns the cv2.LUT table of labelColors.
+def colorLookupTable(high, low, colorNames):
+    if len(colorNames) > 8:
+        raise ValueError('At most 8 colors fit in the label image.')
+    values = np.arange(256)
+    table = np.zeros((256, 1, 3), dtype=np.uint8)
+    for bit, color in enumerate(colorNames):
+        for channel in range(3):
+            inside = ((values >= low[color][channel])
+                    & (values <= high[color][channel]))
+            table[inside, 0, channel] |= 1 << bit
+    return table
+
+def labelWithLookup(img, table):
+    b, g, r = cv2.split(cv2.LUT(img, table))
+    return cv2.bitwise_and(cv2.bitwise_and(b, g), r)
 
 # TODO Make this less lighting dependant (HSV?) Better name?
 def getColors(img):
@@ -640,12 +1182,117 @@ def drawPieces(img, pieces):
         piece.draw(img)
 
 #Return a list of piece objects made from the given list of contours.
+@instrument("indentifyPieces", "pieces")
 def indentifyPieces(contours, img):
+    classified = None
+    if isinstance(contours, ClassifiedContours):
+        classified = contours.classification()
+    if classified is not None:
+        centers, shapes = classified
+    else:
+        centers = [getCenter(cont) for cont in contours]
+        shapes = classifyContours(contours, centers)
     pObjs = []
-    for cont in contours:
-        pObjs.append(Piece(cont))
+    for i in range(len(contours)):
+        pObjs.append(Piece(contours[i], centers[i], shapes[i]))
     return pObjs
 
+#Returns the (name, theta, spin, rcIndex) of each contour, the same values
+#Piece finds one contour at a time.
+@instrument("classifyContours")
+def classifyContours(contours, centers = None):
+    """ NOTES
+        All the 4 vertex contours are stacked into one (n, 4, 2) array and all
+        the 3 vertex contours into one (n, 3, 2) array, so the side ratio and
+        angle tests and the angle from the x axis run once per shape size
+        instead of once per contour. Every step follows the arithmetic of the
+        Piece methods so ties and thresholds come out the same.
+        """
+    if centers is None:
+        centers = [getCenter(cont) for cont in contours]
+    shapes = [("NON_PIECE", None, None, None)] * len(contours)
+    sizes = np.array([len(cont) for cont in contours])
+
+    quads = np.nonzero(sizes == 4)[0]
+    if len(quads) > 0:
+        points = np.array([contours[i].reshape(4, 2) for i in quads])
+        for i, shape in zip(quads, classifyQuads(points)):
+            shapes[i] = shape
+
+    triangles = np.nonzero(sizes == 3)[0]
+    if len(triangles) > 0:
+        points = np.array([contours[i].reshape(3, 2) for i in triangles])
+        center = np.array([centers[i] for i in triangles])
+        for i, shape in zip(triangles, classifyTriangles(points, center)):
+            shapes[i] = shape
+    return shapes
+
+#Classifies an (n, 4, 2) array of contour points as squares, parallelograms
+#or NON_PIECEs like Piece.isSquare and Piece.isParallelogram.
+def classifyQuads(points):
+    lengths, angles = polygonSidesAndAngles(points)
+    nextLengths = np.roll(lengths, -1, axis=1)
+    nextAngles = np.roll(angles, -1, axis=1)
+    notSquare = ((np.abs(nextLengths - lengths) > .1 * lengths)
+               & (np.abs(nextAngles - np.pi / 2) > 0.1))
+    square = ~notSquare.any(axis=1)
+    d = np.abs(lengths[:, :2] - lengths[:, 2:])
+    parallelogram = ~square & ~(d > 0.1 * lengths[:, :2]).any(axis=1)
+
+    #Square: angle of the diagonal from the upper left to the lower right
+    #corner, the first corner with the smallest or largest x + y.
+    sums = points.sum(axis=2)
+    rows = np.arange(len(points))
+    diagonal = (points[rows, sums.argmin(axis=1)]
+              - points[rows, sums.argmax(axis=1)])
+    squareTheta = xAxisAngles(diagonal) + 0.75 * np.pi
+    squareTheta[squareTheta > 0] -= np.pi / 2
+
+    #Parallelogram: angle of the side from vertex 1 to vertex 0, turned for
+    #the spin. Sides 3 and 0 are the ones from vertex 0.
+    ccw = lengths[:, 3] - lengths[:, 0] > 0
+    parallelogramTheta = xAxisAngles(points[:, 0] - points[:, 1])
+    parallelogramTheta[~ccw] += 0.75 * np.pi
+    parallelogramTheta[parallelogramTheta < -np.pi / 2] += np.pi
+
+    shapes = []
+    for i in range(len(points)):
+        if square[i]:
+            shapes.append(("square", squareTheta[i], None, None))
+        elif parallelogram[i]:
+            spin = "CCW" if ccw[i] else "CW"
+            shapes.append(("parallelogram", parallelogramTheta[i], spin, None))
+        else:
+            shapes.append(("NON_PIECE", None, None, None))
+    return shapes
+
+#Classifies an (n, 3, 2) array of contour points, with their (n, 2) centers,
+#as triangles or NON_PIECEs like Piece.isRightIsosceles.
+def classifyTriangles(points, centers):
+    lengths = polygonSidesAndAngles(points)[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = np.sort(lengths / lengths.min(axis=1)[:, None], axis=1)
+    triangle = ((scaled[:, 1] - 1.0 < 0.1)
+              & (np.abs(scaled[:, 2] - math.sqrt(2)) < 0.1))
+
+    #The right angled corner is the first one closest to the center.
+    offsets = points - centers[:, None, :]
+    rcIndex = np.sqrt((offsets * offsets).sum(axis=2)).argmin(axis=1)
+    rows = np.arange(len(points))
+    v1 = points[rows, rcIndex] - points[rows, (rcIndex + 1) % 3]
+    ang = xAxisAngles(v1) - np.pi
+    mag = np.abs(ang)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        theta = (mag % (2 * np.pi)) * (ang / mag)
+
+    shapes = []
+    for i in range(len(points)):
+        if triangle[i]:
+            shapes.append(("triangle", theta[i], None, int(rcIndex[i])))
+        else:
+            shapes.append(("NON_PIECE", None, None, None))
+    return shapes
+
 #Returns a tuple of the contour's center coords.
 def getCenter(contour):
     M = cv2.moments(contour)
@@ -653,16 +1300,28 @@ def getCenter(contour):
     cy = M['m01'] / M['m00']
     return (cx, cy)
 
-#Reduces contours to the actual number of stickers identified
-def reduceToBlocks(contours):
+#Reduces contours to the actual number of stickers identified. areaScale
+#scales the area limits for images that were resized, minAreaScale scales
+#the lower one instead when given, and vertexCounts of None keeps polygons
+#with any number of vertices.
+@instrument("reduceToBlocks", "blocks")
+def reduceToBlocks(contours, areaScale = 1.0, vertexCounts = (3, 4),
+                   minAreaScale = None):
+    if minAreaScale is None:
+        minAreaScale = areaScale
     valid = []
     #Approximate a polygon for each contour
     for cont in contours:
+        #The polygon's vertices are points of the contour, so it can't be
+        #larger than the box around them. Skips approximating the specks.
+        x, y, w, h = cv2.boundingRect(cont)
+        if (w - 1) * (h - 1) <= MIN_BLOCK_AREA * minAreaScale:
+            continue
         eps = 0.05 * cv2.arcLength(cont, True)
         approx = cv2.approxPolyDP(cont, eps, True)
         #make sure the polygon approximated has 3 or 4 sides
         size = len(approx)
-        if size == 3 or size == 4:
+        if vertexCounts is None or size in vertexCounts:
             valid.append(approx)
     
     contours = copy.copy(valid)
@@ -671,11 +1330,116 @@ def reduceToBlocks(contours):
     #Make sure the area of the contour is roughly the correct size
     for cont in contours:
         area = cv2.contourArea(cont)
-        if area > 100 and area < 100000:
+        if (area > MIN_BLOCK_AREA * minAreaScale
+                and area < MAX_BLOCK_AREA * areaScale):
             valid.append(cont)
 
     return valid
 
+#Returns the side lengths and corner angles of polygons given as (..., n, 2)
+#integer points, side i going from vertex i to vertex i + 1. They are the same
+#float64 values as dist and angleBetween give one vertex at a time.
+def polygonSidesAndAngles(points):
+    previous = np.roll(points, 1, axis=-2)
+    following = np.roll(points, -1, axis=-2)
+    offsets = following - points
+    lengths = np.sqrt((offsets * offsets).sum(axis=-1).astype(np.float64))
+
+    #Angle between the vectors to the previous and next vertex.
+    toPrevious = previous - points
+    toNext = following - points
+    cosang = (toPrevious * toNext).sum(axis=-1)
+    sinang = (toPrevious[..., 0] * toNext[..., 1]
+            - toPrevious[..., 1] * toNext[..., 0])
+    return lengths, wrapAngles(np.arctan2(sinang, cosang))
+
+#Returns angleBetween([1, 0], v) for an (n, 2) array of vectors.
+def xAxisAngles(vectors):
+    return wrapAngles(np.arctan2(vectors[:, 1], vectors[:, 0]))
+
+#Wraps an array of angles like angleBetween, so pi becomes -pi.
+def wrapAngles(ang):
+    high = ang >= np.pi
+    low = ang <= -np.pi
+    ang[high] -= 2 * np.pi
+    ang[low] += 2 * np.pi
+    return ang
+
+#A list of contours that also holds the center and shape classifyContours
+#found for each, so indentifyPieces doesn't classify them again.
+class ClassifiedContours(list):
+
+    def __init__(self, contours, centers, shapes):
+        list.__init__(self, contours)
+        self.contours = list(contours)
+        self.centers = centers
+        self.shapes = shapes
+
+    #Returns the centers and shapes of the contours, or None if the list was
+    #changed since it was made.
+    def classification(self):
+        if len(self) != len(self.contours) or any(
+                cont is not other for cont, other in zip(self, self.contours)):
+            return None
+        return self.centers, self.shapes
+
+#Returns the contours without the ones that outline the same piece as a
+#larger contour. The order of the contours kept is unchanged. The result is
+#a ClassifiedContours when there were contours to compare.
+@instrument("removeDuplicates")
+def removeDuplicates(contours, minDist = MIN_DUPLICATE_DIST,
+                     maxOverlap = MAX_DUPLICATE_OVERLAP):
+    """ NOTES
+        RETR_TREE finds both edges of a piece's outline, and colors with
+        overlapping ranges find a piece once per color. This is non maximum
+        suppression: contours that classifyContours names as pieces first,
+        then largest first, a contour is dropped when a kept contour has its
+        center closer than minDist and their convex hulls' intersection is
+        more than maxOverlap of the smaller hull. Dividing by the smaller
+        area rather than the union also drops small fragments that lie
+        inside a larger piece. The overlap test keeps small pieces whose
+        centers are close but that only touch, like two triangles making a
+        square, since their intersection is near 0.
+
+        Kept centers are bucketed in a grid of minDist cells, so each contour
+        is only compared to the kept contours in the 9 cells around it.
+        """
+    if len(contours) < 2:
+        return list(contours)
+    centers = [getCenter(cont) for cont in contours]
+    hulls = [np.float32(cv2.convexHull(cont)) for cont in contours]
+    areas = [cv2.contourArea(hull) for hull in hulls]
+    shapes = classifyContours(contours, centers)
+    scores = [(shape[0] != "NON_PIECE", area) for shape, area
+              in zip(shapes, areas)]
+
+    grid = {}
+    keep = [False] * len(contours)
+    for i in sorted(range(len(contours)), key=lambda i: scores[i],
+                    reverse=True):
+        x, y = centers[i]
+        col, row = int(x // minDist), int(y // minDist)
+        duplicate = False
+        for cell in [(col + dc, row + dr) for dc in (-1, 0, 1)
+                                          for dr in (-1, 0, 1)]:
+            for j in grid.get(cell, []):
+                if math.hypot(x - centers[j][0], y - centers[j][1]) >= minDist:
+                    continue
+                inter = cv2.intersectConvexConvex(hulls[i], hulls[j])[0]
+                smaller = min(areas[i], areas[j])
+                if smaller > 0 and inter / smaller > maxOverlap:
+                    duplicate = True
+                    break
+            if duplicate:
+                break
+        if not duplicate:
+            keep[i] = True
+            grid.setdefault((col, row), []).append(i)
+    kept = [i for i in range(len(contours)) if keep[i]]
+    return ClassifiedContours([contours[i] for i in kept],
+                              [centers[i] for i in kept],
+                              [shapes[i] for i in kept])
+
 #Retruns the Euclidian distance between two points.
 def dist(a, b):
     return np.linalg.norm(a - b)
@@ -711,4 +1475,61 @@ def getUpperLeft(cont):
     for pt in cont:
         if sum(pt[0]) == minVal:
             return pt[0]
-    return None
\ No newline at end of file
+    return None
+
+#Rectangles are (x, y, w, h) tuples, like cv2.boundingRect returns.
+def rectsOverlap(a, b):
+    return(     a[0] < b[0] + b[2] and b[0] < a[0] + a[2]
+            and a[1] < b[1] + b[3] and b[1] < a[1] + a[3] )
+
+#Returns true if rectangle a holds all of rectangle b.
+def rectContains(a, b):
+    return(     a[0] <= b[0] and b[0] + b[2] <= a[0] + a[2]
+            and a[1] <= b[1] and b[1] + b[3] <= a[1] + a[3] )
+
+def unionRect(a, b):
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y, max(a[0] + a[2], b[0] + b[2]) - x,
+                  max(a[1] + a[3], b[1] + b[3]) - y)
+
+def growRect(rect, margin):
+    x, y, w, h = rect
+    return (x - margin, y - margin, w + 2 * margin, h + 2 * margin)
+
+#Returns true if the contour is within a pixel of an edge of rect that isn't
+#also an edge of the frame.
+def touchesEdge(contour, rect, width, height):
+    x, y, w, h = rect
+    points = contour.reshape(-1, 2)
+    return(     (x > 0 and (points[:, 0] <= x + 1).any())
+            or  (y > 0 and (points[:, 1] <= y + 1).any())
+            or  (x + w < width and (points[:, 0] >= x + w - 2).any())
+            or  (y + h < height and (points[:, 1] >= y + h - 2).any()) )
+
+#Returns the rectangles with every overlapping group joined into one.
+def mergeRects(rects):
+    merged = list(rects)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                if rectsOverlap(merged[i], merged[j]):
+                    merged[i] = unionRect(merged[i], merged[j])
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+#Returns the rectangles cut to the frame, dropping empty ones.
+def clipRects(rects, width, height):
+    clipped = []
+    for x, y, w, h in rects:
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + w, width), min(y + h, height)
+        if x2 > x1 and y2 > y1:
+            clipped.append((x1, y1, x2 - x1, y2 - y1))
+    return clipped
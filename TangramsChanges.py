@@ -0,0 +1,176 @@
+import numpy as np
+import cv2
+from Tangrams import *
+
+#Fraction of the frame size the change detector works at.
+CHANGE_SCALE = 0.125
+#Smallest difference in gray level that counts as a change, well above
+#sensor noise on the downscaled frame.
+CHANGE_THRESHOLD = 20
+#Fewest changed pixels of the downscaled frame that make it dirty.
+MIN_CHANGED_PIXELS = 2
+#Pixels added around every dirty region before segmenting it again.
+REGION_MARGIN = 16
+#Times the dirty regions may grow to fit cut pieces before the whole frame
+#is segmented instead.
+MAX_REGION_GROWTH = 4
+
+#Finds the regions of a frame that changed since the last frame processed.
+class ChangeDetector:
+
+    def __init__(self, scale = CHANGE_SCALE, threshold = CHANGE_THRESHOLD,
+                 minPixels = MIN_CHANGED_PIXELS):
+        self.scale = scale
+        self.threshold = threshold
+        self.minPixels = minPixels
+        #Downscaled gray frame the next frames are compared to. It is only
+        #replaced by dirty frames so slow drift still adds up to a change.
+        self.reference = None
+
+    #Returns the (x, y, w, h) rectangles of the frame that changed, in full
+    #resolution, or an empty list if the frame is the same as the reference.
+    def update(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale,
+                           interpolation=cv2.INTER_AREA)
+        height, width = img.shape[:2]
+
+        if self.reference is None or self.reference.shape != small.shape:
+            self.reference = small
+            return [(0, 0, width, height)]
+
+        diff = cv2.absdiff(small, self.reference)
+        ret, mask = cv2.threshold(diff, self.threshold, 255,
+                                  cv2.THRESH_BINARY)
+        if cv2.countNonZero(mask) < self.minPixels:
+            return []
+        self.reference = small
+
+        mask = cv2.dilate(mask, None)
+        _, contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL,
+                                          cv2.CHAIN_APPROX_SIMPLE)
+        rects = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            rects.append((int(x / self.scale), int(y / self.scale),
+                          int(np.ceil(w / self.scale)),
+                          int(np.ceil(h / self.scale))))
+        return clipRects(mergeRects(rects), width, height)
+
+#Runs detection only on the frames, and the parts of frames, that changed.
+class IncrementalDetector:
+
+    def __init__(self, tracker = None, changes = None, find = findValid,
+                 cache = None):
+        """ NOTES
+            Unchanged frames return the last pieces and connections without
+            any detection. Otherwise only the dirty regions, grown to cover
+            every old contour they touch, are segmented with find again and
+            the contours outside them are kept. tracker is an optional
+            TangramsTracker.PieceTracker, so pieces that were segmented again
+            but didn't move keep their geometry. cache is an optional
+            Tangrams.ConnectionCache for the connections when there is no
+            tracker, a tracker uses the cache it was made with.
+            """
+        if changes is None:
+            changes = ChangeDetector()
+        self.changes = changes
+        self.tracker = tracker
+        self.find = find
+        self.cache = cache
+        self.contours = None
+        #Regions segmented for the last processed frame.
+        self.regions = []
+        self.pieces = []
+        self.connections = []
+        self.frames = 0
+        self.processed = 0
+        #Fraction of every frame's pixels that was segmented, summed.
+        self.pixels = 0.0
+
+    #Returns the pieces and connections of the frame.
+    def update(self, img):
+        self.frames += 1
+        regions = self.changes.update(img)
+        if len(regions) == 0 and self.contours is not None:
+            return self.pieces, self.connections
+
+        height, width = img.shape[:2]
+        if self.contours is None:
+            regions = [(0, 0, width, height)]
+        valid = self.findInRegions(img, regions)
+        self.contours = valid
+
+        self.processed += 1
+        self.pixels += sum(w * h for x, y, w, h in self.regions) / float(
+            width * height)
+        if self.tracker is not None:
+            self.pieces, self.connections = self.tracker.update(valid)
+        else:
+            self.pieces = indentifyPieces(valid, img)
+            self.connections = findConnections(self.pieces, cache=self.cache)
+        return self.pieces, self.connections
+
+    #Returns the contours of the frame, segmenting only the regions and
+    #keeping the old contours outside them.
+    def findInRegions(self, img, regions):
+        height, width = img.shape[:2]
+        oldContours = self.contours or []
+        for attempt in range(MAX_REGION_GROWTH):
+            regions = self.coverContours(oldContours, regions, width, height)
+            found = []
+            grown = []
+            for rect in regions:
+                x, y, w, h = rect
+                offset = np.int32([x, y])
+                for contour in self.find(img[y:y + h, x:x + w]):
+                    contour = contour + offset
+                    found.append(contour)
+                    #A piece cut by the region's edge is only partly found.
+                    if touchesEdge(contour, rect, width, height):
+                        rect = unionRect(rect, growRect(
+                            cv2.boundingRect(contour), REGION_MARGIN))
+                grown.append(rect)
+            if grown == regions:
+                break
+            regions = grown
+        else:
+            #Regions keep growing, segment the whole frame instead.
+            regions = [(0, 0, width, height)]
+            found = list(self.find(img))
+
+        self.regions = regions
+        kept = [contour for contour in oldContours
+                if not any(rectsOverlap(cv2.boundingRect(contour), rect)
+                           for rect in regions)]
+        return kept + found
+
+    #Grows the regions until none of the contours is only partly inside.
+    def coverContours(self, contours, regions, width, height):
+        boxes = [cv2.boundingRect(contour) for contour in contours]
+        regions = mergeRects([growRect(rect, REGION_MARGIN)
+                              for rect in regions])
+        changed = True
+        while changed:
+            changed = False
+            for box in boxes:
+                for i, rect in enumerate(regions):
+                    if rectsOverlap(box, rect) and not rectContains(rect, box):
+                        regions[i] = unionRect(rect, growRect(box,
+                                                              REGION_MARGIN))
+                        changed = True
+            regions = mergeRects(regions)
+        return clipRects(regions, width, height)
+
+    #Fraction of the frames that went through detection.
+    def processedFraction(self):
+        return self.processed / float(max(self.frames, 1))
+
+    #Fraction of all pixels seen that were segmented.
+    def pixelFraction(self):
+        return self.pixels / max(self.frames, 1)
+
+    def report(self):
+        print("Processed %d of %d frames (%.1f%%), %.1f%% of pixels"
+              % (self.processed, self.frames, 100 * self.processedFraction(),
+                 100 * self.pixelFraction()))
@@ -0,0 +1,180 @@
+import numpy as np
+import cv2
+import os
+
+#cv2 conversion codes from BGR to each supported color space and back.
+TO_COLOR_SPACE = {
+    "BGR": None,
+    "HSV": cv2.COLOR_BGR2HSV
+}
+FROM_COLOR_SPACE = {
+    "BGR": None,
+    "HSV": cv2.COLOR_HSV2BGR
+}
+
+#Precomputed 3D lookup table that maps a pixel to its piece colors.
+class ColorTable:
+
+    def __init__(self, table, colorNames, colorSpace = "BGR"):
+        """ NOTES
+            table[c0, c1, c2] holds the color labels of every pixel in that
+            bin as bit flags, bit n set meaning colorNames[n]. These are the
+            same labels as Tangrams.labelColors, so colors may overlap.
+            c0, c1, c2 are the channels of colorSpace divided by the bin
+            width, 256 / bins.
+            """
+        if table.ndim != 3 or len(set(table.shape)) != 1:
+            raise ValueError('The table must have the same bins per channel.')
+        if 256 % table.shape[0] != 0:
+            raise ValueError('The number of bins must divide 256.')
+        if colorSpace not in TO_COLOR_SPACE:
+            raise ValueError('Unknown color space ' + str(colorSpace))
+        self.table = np.ascontiguousarray(table, dtype=np.uint8)
+        self.colorNames = list(colorNames)
+        self.colorSpace = colorSpace
+        self.bins = table.shape[0]
+        self.shift = int(np.log2(256 // self.bins))
+
+    #Returns the label image of an image already in this table's color space.
+    def classify(self, img):
+        #Index into the flattened table, cheaper than indexing by 3 arrays.
+        bits = int(np.log2(self.bins))
+        index = np.right_shift(img, self.shift).astype(np.intp)
+        index = ((index[:, :, 0] << (2 * bits)) | (index[:, :, 1] << bits)
+                | index[:, :, 2])
+        return self.table.ravel().take(index)
+
+    #Converts a BGR camera image into this table's color space.
+    def convert(self, img):
+        code = TO_COLOR_SPACE[self.colorSpace]
+        if code is None:
+            return img
+        return cv2.cvtColor(img, code)
+
+    #Returns an equivalent table that classifies images in colorSpace.
+    def inColorSpace(self, colorSpace):
+        if colorSpace == self.colorSpace:
+            return self
+        #Every bin center of the new space converted back to BGR and then to
+        #this table's space, so it is labeled the same way this table would.
+        centers = binCenters(self.bins).astype(np.uint8)
+        grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'),
+                        axis=-1).reshape(self.bins * self.bins, self.bins, 3)
+        code = FROM_COLOR_SPACE[colorSpace]
+        if code is not None:
+            grid = cv2.cvtColor(grid, code)
+        grid = self.convert(grid)
+        table = self.classify(grid).reshape(self.bins, self.bins, self.bins)
+        return ColorTable(table, self.colorNames, colorSpace)
+
+    #Saves the table with its color names, color space and bins as a .npz
+    #file, so loading it can tell whether it is the table asked for.
+    def save(self, path):
+        with open(path, 'wb') as outfile:
+            np.savez(outfile, table=self.table,
+                     colorNames=np.array(self.colorNames, dtype="U"),
+                     colorSpace=np.array(self.colorSpace, dtype="U"),
+                     bins=self.bins)
+
+### Free Functions ###
+
+#Returns the value at the center of each bin of a channel.
+def binCenters(bins):
+    width = 256 // bins
+    return np.arange(bins) * width + width // 2
+
+#Returns a table built from upper and lower bounds for each color, like the
+#ones from Tangrams.getColors. With 256 bins it gives exactly the same labels
+#as cv2.inRange, with fewer bins each bin is labeled by its center.
+def makeColorTableFromRanges(high, low, colorNames, bins = 256,
+                             colorSpace = "BGR"):
+    if len(colorNames) > 8:
+        raise ValueError('At most 8 colors fit in the label image.')
+    centers = binCenters(bins)
+    channels = []
+    for channel in range(3):
+        flags = np.zeros(bins, dtype=np.uint8)
+        for bit, color in enumerate(colorNames):
+            inside = ((centers >= low[color][channel])
+                    & (centers <= high[color][channel]))
+            flags[inside] |= 1 << bit
+        channels.append(flags)
+    table = (channels[0][:, None, None]
+           & channels[1][None, :, None]
+           & channels[2][None, None, :])
+    return ColorTable(table, colorNames, colorSpace)
+
+#Returns a table built from calibration pixels. samples maps each color name
+#to an (N, 3) array of pixels of that color in colorSpace, for example
+#img[mask > 0] from a hand labeled image. A bin gets a color if at least
+#minCount of its pixels were in the samples.
+def makeColorTableFromSamples(samples, bins = 32, colorSpace = "BGR",
+                              minCount = 1, colorNames = None):
+    """ NOTES
+        colorNames gives the bit order of the colors. By default it is the
+        sorted names, not the order of samples.keys(), which can change from
+        run to run.
+        """
+    if colorNames is None:
+        colorNames = sorted(samples)
+    if set(colorNames) != set(samples):
+        raise ValueError('colorNames must name every color of the samples.')
+    if len(colorNames) > 8:
+        raise ValueError('At most 8 colors fit in the label image.')
+    shift = int(np.log2(256 // bins))
+    table = np.zeros(bins ** 3, dtype=np.uint8)
+    for bit, color in enumerate(colorNames):
+        pixels = np.right_shift(np.asarray(samples[color], dtype=np.uint8),
+                                shift).reshape(-1, 3).astype(np.intp)
+        index = (pixels[:, 0] * bins + pixels[:, 1]) * bins + pixels[:, 2]
+        counts = np.bincount(index, minlength=bins ** 3)
+        table[counts >= minCount] |= 1 << bit
+    return ColorTable(table.reshape(bins, bins, bins), colorNames, colorSpace)
+
+#Loads a table saved by ColorTable.save. Raises ValueError if the file is
+#not such a table or if its color names, color space or bins are not the
+#ones given. Leave any of them None to accept what the file has.
+def loadColorTable(path, colorNames = None, colorSpace = None, bins = None):
+    with open(path, 'rb') as infile:
+        try:
+            saved = np.load(infile)
+            fields = dict((name, saved[name]) for name in
+                          ["table", "colorNames", "colorSpace", "bins"])
+        except (IOError, IndexError, KeyError, TypeError, ValueError):
+            raise ValueError('Not a saved color table: ' + path)
+    savedNames = [str(name) for name in fields["colorNames"].tolist()]
+    savedSpace = str(fields["colorSpace"].item())
+    savedBins = int(fields["bins"])
+    if colorNames is not None and list(colorNames) != savedNames:
+        raise ValueError('The table at ' + path + ' is for the colors '
+                         + ", ".join(savedNames))
+    if colorSpace is not None and colorSpace != savedSpace:
+        raise ValueError('The table at ' + path + ' is in ' + savedSpace)
+    if bins is not None and bins != savedBins:
+        raise ValueError('The table at ' + path + ' has ' + str(savedBins)
+                         + ' bins')
+    colorTable = ColorTable(fields["table"], savedNames, savedSpace)
+    if colorTable.bins != savedBins:
+        raise ValueError('Not a saved color table: ' + path)
+    return colorTable
+
+#Loads the table at path, or builds it with build() and saves it there.
+#path should end in .npz. The table is built again when the saved one is
+#for other colors, another color space or another number of bins, but not
+#when the color ranges or the calibration images change, so delete the file
+#then.
+def cachedColorTable(path, colorNames, build, colorSpace = "BGR",
+                     bins = None):
+    if os.path.exists(path):
+        try:
+            return loadColorTable(path, colorNames, colorSpace, bins)
+        except ValueError:
+            pass
+    colorTable = build()
+    if (colorTable.colorNames != list(colorNames)
+            or colorTable.colorSpace != colorSpace
+            or (bins is not None and colorTable.bins != bins)):
+        raise ValueError('build() made a table for other colors, another '
+                         'color space or another number of bins.')
+    colorTable.save(path)
+    return colorTable
@@ -1,34 +1,190 @@
-import copy
+import hashlib
 import Tangrams
-#################################################
-##### TODO BUILD STRESS TESTER FOR EQUALITY #####
-#################################################
+from TangramsStats import instrument
+#Equality is stress tested by graphStressTest.py.
 
+#Number of neighborhood refinement rounds used by graphSignature.
+SIGNATURE_ITERATIONS = 3
+#Sums of label hashes are kept below this, the number of sha1 digests.
+LABEL_SUM_MODULUS = 2 ** 160
+#Names of the pieces TangramsGraphCounts counts connections to, by row.
+COUNT_NAMES = ["square","triangle","parallelogram"]
 
 class TangramsGraph:
 
     def __init__(self,toCopy = None):
+        """ NOTES
+            The graph only refers to the Piece and Connection objects it is
+            given, by identity, and never changes or copies them. Copies of a
+            graph share the same pieces and connections, so nothing heavier
+            than the dicts and lists of the graph itself is ever copied.
+
+            The graph itself is not immutable. Copying it is cheap, so code
+            that needs a graph to stay as it is, like a target, keeps its own
+            copy with TangramsGraph(graph) instead.
+
+            Pieces and connections can be added and removed one at a time,
+            like the moves of a live session. Once signature() and
+            countsMatch have been called, everything behind them is kept up
+            to date instead of being thrown away:
+
+                piece counts        the two pieces of a changed connection
+                key counts          the connections of those two pieces
+                labels              the pieces within SIGNATURE_ITERATIONS
+                                    connections of a change, on the next
+                                    signature() call
+                signature           the sum of the hashes of the final
+                                    labels, moved by the labels that changed
+
+            So after a move, comparing the board with a target takes time in
+            the number of connections near the move, not on the whole board.
+            The first call of each still goes over the whole graph.
+            """
         self.pieces = {}
         self.connections = {}
-        if toCopy != None:
-            self.pieces = copy.deepcopy(toCopy.pieces)
-            self.connections = copy.deepcopy(toCopy.connections)
+        #TangramsGraphCounts of each piece, made when first asked for by
+        #getPieceCounts and kept up to date after.
+        self.countsCache = {}
+        #Labels of every piece after each round of graphSignature, made by
+        #the first signature() call, and the pieces whose connections
+        #changed since they were last brought up to date.
+        self.labels = None
+        self.dirty = set()
+        #Sum of the hashes of the final labels, see labelsDigest.
+        self.labelSum = None
+        self.signatureCache = None
+        #Result of connectionKeyCounts, made when first asked for and kept up
+        #to date after.
+        self.keyCountsCache = None
+        if toCopy is not None:
+            for piece in toCopy.pieces:
+                self.pieces[piece] = list(toCopy.pieces[piece])
+            self.connections = dict(toCopy.connections)
+            self.countsCache = dict((piece, counts.copy()) for piece, counts
+                                    in toCopy.countsCache.items())
+            if toCopy.labels is not None:
+                self.labels = [dict(labels) for labels in toCopy.labels]
+            self.dirty = set(toCopy.dirty)
+            self.labelSum = toCopy.labelSum
+            self.signatureCache = toCopy.signatureCache
+            if toCopy.keyCountsCache is not None:
+                self.keyCountsCache = dict(toCopy.keyCountsCache)
 
     def addPiece(self, node):
+        if node in self.pieces:
+            return
         self.pieces[node] = []
+        self.changed(node)
+
+    #Removes the piece and its connections.
+    def removePiece(self, node):
+        for connection in list(self.pieces[node]):
+            self.removeConnection(connection)
+        del self.pieces[node]
+        self.countsCache.pop(node, None)
+        self.changed(node)
 
     def addConnection(self, connection):
         piece1 = connection.pieces[0]
         piece2 = connection.pieces[1]
 
-        #Add connection to connection dict.
-        self.connections[connection] = [piece1, piece2]
+        #Add connection to connection dict, unless it is already there.
+        pair = [piece1, piece2]
+        if self.connections.setdefault(connection, pair) is not pair:
+            return
+        self.countKeys(piece1, piece2, -1)
         #Add each the connection to each piece.
         self.pieces[piece1].append(connection)
         self.pieces[piece2].append(connection)
+        if self.countsCache:
+            self.countConnection(connection, 1)
+        self.countKeys(piece1, piece2, 1)
+        self.changed(piece1, piece2)
+
+    def removeConnection(self, connection):
+        piece1, piece2 = self.connections[connection]
+        self.countKeys(piece1, piece2, -1)
+        del self.connections[connection]
+        self.pieces[piece1].remove(connection)
+        self.pieces[piece2].remove(connection)
+        if self.countsCache:
+            self.countConnection(connection, -1)
+        self.countKeys(piece1, piece2, 1)
+        self.changed(piece1, piece2)
+
+    #Adds step of the connection to the counts of both its pieces.
+    def countConnection(self, connection, step):
+        for index, piece in enumerate(connection.pieces):
+            if piece in self.countsCache:
+                self.countsCache[piece].add(connection.pieces[1 - index],
+                                            connection.connectionType, step)
+
+    #Adds step to the key counts of every connection of the two pieces,
+    #which are all the keys a change to their connections can move. Called
+    #with -1 before the change and 1 after.
+    def countKeys(self, piece1, piece2, step):
+        keyCounts = self.keyCountsCache
+        if keyCounts is None:
+            return
+        connections = set(self.pieces[piece1])
+        connections.update(self.pieces[piece2])
+        counts = {}
+        for connection in connections:
+            for piece in connection.pieces:
+                if piece not in counts:
+                    counts[piece] = self.getPieceCounts(piece).key()
+            key = connectionKey(connection, counts)
+            count = keyCounts.get(key, 0) + step
+            if count:
+                keyCounts[key] = count
+            else:
+                del keyCounts[key]
+
+    #Marks the labels of the pieces and the signature out of date. Until the
+    #first signature() there are no labels to update.
+    def changed(self, *pieces):
+        if self.labels is not None:
+            self.dirty.update(pieces)
+        self.signatureCache = None
+
+    #Throws away the counts and labels, so they are worked out from scratch
+    #when next needed.
+    def clearCaches(self):
+        self.countsCache = {}
+        self.labels = None
+        self.dirty = set()
+        self.labelSum = None
+        self.signatureCache = None
+        self.keyCountsCache = None
+
+    #Returns the canonical signature of the graph. Graphs with different
+    #signatures never match.
+    def signature(self):
+        if self.signatureCache is None:
+            if self.labels is None:
+                self.labels = signatureLabels(self)
+                self.labelSum = labelsSum(self.labels[-1].values())
+            else:
+                old, new = updateSignatureLabels(self, self.labels,
+                                                 self.dirty)
+                self.labelSum += labelsSum(new) - labelsSum(old)
+            self.dirty = set()
+            self.signatureCache = labelsDigest(self.labelSum)
+        return self.signatureCache
 
     def __eq__(self, other):
-        return self.countsMatch(other) and self.symmetriesMatch(other) 
+        if not isinstance(other, TangramsGraph):
+            return False
+        #countsMatch only runs to rule out a signature collision.
+        return(     self.signature() == other.signature()
+                and self.countsMatch(other)
+                and self.symmetriesMatch(other) )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.signature())
 
     """ countsMatch Description:
         Check to make sure each connection has a match on the other graph that
@@ -40,8 +196,15 @@ class TangramsGraph:
             Still fails if a piece is connected with the correct type of
             connection to the correct piece but with the wrong side/point.
 
-            Uses while loops because things are being removed mid loop. Using
-            for loops in this scenario leads to wierd stuff.
+            A connection can be paired with one of other when isSimilar and
+            PieceCountsMatch are both true. Each compares the two ends of the
+            connections as an unordered pair, so each is an equivalence and
+            so are both together: connectionKey is the same for two
+            connections exactly when they can be paired. The connections of
+            the two graphs with the same key are all interchangeable, so
+            every connection can be paired exactly when each key has as many
+            connections in both graphs. That is the whole bipartite matching,
+            in time linear in the number of connections.
             """
 
         #Check to make sure graphs have same number of connections & pieces.
@@ -50,72 +213,28 @@ class TangramsGraph:
            ):
             return False
 
-        #Create copies so items can be removed from the dictionaries as
-        #matches are found.
-        connections = copy.deepcopy(self.connections)
-        otherConnections = copy.deepcopy(other.connections)
-
-        #Loop over all connections of the first graph.
-        selfIndex = 0
-        while(selfIndex < len(connections)):
-            #The current connection in self being paired.
-            connection = connections.keys()[selfIndex]
-
-            #Used to break the inner loop if a piece is found.
-            pairFound = False
-
-            #Get counts of selfs current connection.
-            selfCounts1 = self.getPieceCounts(connection.pieces[0])
-            selfCounts2 = self.getPieceCounts(connection.pieces[1])
-
-            otherIndex = 0
-            while(otherIndex < len(otherConnections)):
-
-                #The current connection in other being tested for pairing.
-                oConnection = otherConnections.keys()[otherIndex]
-
-                #Only proceed if the these are the same type of connection,
-                #with the same kinds of pieces.
-                if(connection.isSimilar(oConnection)):
-
-                    #Get counts of oConnection.
-                    otherCounts1 = other.getPieceCounts(oConnection.pieces[0])
-                    otherCounts2 = other.getPieceCounts(oConnection.pieces[1])
-
-                    #If counts match remove the pair from their lists
-                    if( self.PieceCountsMatch(selfCounts1, selfCounts2,
-                                        otherCounts1, otherCounts2)
-                        ):
-                        #Match Found remove connections from lists.
-                        del connections[connection]
-                        del otherConnections[oConnection]
-                        otherIndex -= 1
-                        selfIndex -= 1
+        return self.connectionKeyCounts() == other.connectionKeyCounts()
 
-                        #Trip flag to break loop.
-                        pairFound = True
-
-                if (pairFound):
-                    break
-
-                otherIndex += 1
-            #Quit if no pair was found for current piece
-            if(not pairFound):
-                #print("no pair found for " + str(connection))
-                return False
-
-            selfIndex += 1
-        #print("First Graph unmatched" + str(connections.keys()))
-        #print("Second Graph unmatched" + str(otherConnections.keys()))
-
-        return True
+    #Returns the number of connections of the graph with each connectionKey.
+    #Do not change the result, it is kept up to date as the graph changes.
+    def connectionKeyCounts(self):
+        if self.keyCountsCache is None:
+            counts = dict((piece, self.getPieceCounts(piece).key())
+                          for piece in self.pieces if self.pieces[piece])
+            keys = {}
+            for connection in self.connections:
+                key = connectionKey(connection, counts)
+                keys[key] = keys.get(key, 0) + 1
+            self.keyCountsCache = keys
+        return self.keyCountsCache
 
     """ symmetriesMatch Description:
         Returns true if the pieces with symmetries have connections in the
         correct locations.
         """
     def symmetriesMatch(self, other):
-        pass
+        #TODO Check the symmetries. Until then they always match.
+        return True
 
     def PieceCountsMatch(self, counts1, counts2, oCounts1, oCounts2):
         if(counts1 == oCounts1 and counts2 == oCounts2):
@@ -126,7 +245,9 @@ class TangramsGraph:
 
     #Returns the number of pieces of each type that it is connected to.
     def getPieceCounts(self, piece):
-        return TangramsGraphCounts(self, piece)
+        if piece not in self.countsCache:
+            self.countsCache[piece] = TangramsGraphCounts(self, piece)
+        return self.countsCache[piece]
     
     def display(self):
         print ("\nConnections")
@@ -155,46 +276,150 @@ class TangramsGraph:
 #Container for the counts of connection and piece type from the given piece.
 class TangramsGraphCounts:
 
-    def __init__(self, graph, piece):
-        '''NOTES
-            'piece in self.pieces' does not return true even if piece is in
-            the pieces dict. I think this is from the deepcopy that is done in
-            the countsMatch function, but I need that to be able to remove the
-            connections from the list without destroying the original data.
-            Becuase of the above I've come up with the solution you see below.
-        '''
-        originalPiece = None
+    def __init__(self, graph = None, piece = None):
         self.counts = [[0]*3 for i in xrange(3)]
-        countIndexes = ["square","triangle","parallelogram"]
-
-        #Weird hacky thing to get the piece from the dictionary into a variable
-        for currentPiece in graph.pieces:
-            if( str(piece) == str(currentPiece) ):
-                originalPiece = currentPiece
-                break
+        if graph is None:
+            return
 
         #Shouldn't happen, but just in case.
-        if originalPiece == None:
+        if piece not in graph.pieces:
             raise ValueError('The piece is not in the graph dictionary.')
 
-
-        for connection in graph.pieces[originalPiece]:
+        for connection in graph.pieces[piece]:
             # 1 - the index gives the other index of the list of length 2
-            otherPieceIndex = 1 - connection.pieces.index(originalPiece)
+            otherPieceIndex = 1 - connection.pieces.index(piece)
             otherPiece = connection.pieces[otherPieceIndex]
-            if otherPiece.name in countIndexes:
-                countIndex = countIndexes.index(otherPiece.name)
-                self.counts[countIndex][connection.connectionType] += 1
+            self.add(otherPiece, connection.connectionType)
+
+    #Counts step more connections of the type to otherPiece.
+    def add(self, otherPiece, connectionType, step = 1):
+        if otherPiece.name in COUNT_NAMES:
+            countIndex = COUNT_NAMES.index(otherPiece.name)
+            self.counts[countIndex][connectionType] += step
+
+    #Returns the counts as a tuple of rows.
+    def key(self):
+        return tuple(tuple(row) for row in self.counts)
+
+    def copy(self):
+        counts = TangramsGraphCounts()
+        counts.counts = [list(row) for row in self.counts]
+        return counts
 
     def __eq__(self, other):
         return self.counts == other.counts
 
 
 ### Free Functions ###
+@instrument("makeGraph")
 def makeGraph(pieces, connections):
     g = TangramsGraph()
     for piece in pieces:
         g.addPiece(piece)
     for connection in connections:
         g.addConnection(connection)
-    return copy.deepcopy(g)
\ No newline at end of file
+    return g
+
+#Returns the connection type, the (name, location number) of both ends and
+#the counts of both pieces, from counts of {piece: TangramsGraphCounts key},
+#each pair in a fixed order.
+def connectionKey(connection, counts):
+    piece1, piece2 = connection.pieces
+    end1 = (piece1.name, connection.locationNumbers[0])
+    end2 = (piece2.name, connection.locationNumbers[1])
+    counts1 = counts[piece1]
+    counts2 = counts[piece2]
+    return (connection.connectionType, min(end1, end2), max(end1, end2),
+            min(counts1, counts2), max(counts1, counts2))
+
+""" graphSignature Description:
+    Weisfeiler-Lehman style hash of the graph. Each piece starts labeled by
+    its name, then every round relabels it with its own label and the sorted
+    labels of its neighbors, each paired with the connection type and the
+    location numbers on both ends. The signature is the sum of the hashes of
+    the final labels, so it doesn't depend on the order pieces and
+    connections were added, is the same across runs and processes, and can
+    be moved by just the labels that changed.
+    """
+def graphSignature(graph, iterations = SIGNATURE_ITERATIONS):
+    labels = signatureLabels(graph, iterations)[-1]
+    return labelsDigest(labelsSum(labels.values()))
+
+#Returns the labels of every piece before the first round of graphSignature
+#and after each round, as a list of {piece: label}.
+def signatureLabels(graph, iterations = SIGNATURE_ITERATIONS):
+    rounds = [dict((piece, piece.name) for piece in graph.pieces)]
+    for i in range(iterations):
+        rounds.append(dict((piece, pieceLabel(graph, piece, rounds[-1]))
+                           for piece in graph.pieces))
+    return rounds
+
+#Returns the label of the piece after a round of graphSignature, given the
+#labels of the round before.
+def pieceLabel(graph, piece, labels):
+    neighbors = []
+    for connection in graph.pieces[piece]:
+        index = connection.pieces.index(piece)
+        otherPiece = connection.pieces[1 - index]
+        neighbors.append((connection.connectionType,
+                          connection.locationNumbers[index],
+                          connection.locationNumbers[1 - index],
+                          labels[otherPiece]))
+    neighbors.sort()
+    return hashLabel((labels[piece], neighbors))
+
+#Brings rounds, from signatureLabels, up to date with the graph after the
+#pieces in changed were added or removed or had connections added or
+#removed. A label is only worked out again if the piece's connections or
+#the label of the piece or a neighbor in the round before changed. Returns
+#the final labels that were taken out and the ones put in their place.
+def updateSignatureLabels(graph, rounds, changed):
+    old = []
+    new = []
+    for piece in changed:
+        if piece not in graph.pieces:
+            if piece in rounds[-1]:
+                old.append(rounds[-1][piece])
+            for labels in rounds:
+                labels.pop(piece, None)
+    changed = set(piece for piece in changed if piece in graph.pieces)
+
+    #Pieces whose label in the round before changed.
+    updated = set()
+    for piece in changed:
+        if piece not in rounds[0]:
+            rounds[0][piece] = piece.name
+            updated.add(piece)
+            if len(rounds) == 1:
+                new.append(piece.name)
+    for previous, labels in zip(rounds[:-1], rounds[1:]):
+        redo = set(changed)
+        for piece in updated:
+            redo.add(piece)
+            for connection in graph.pieces[piece]:
+                redo.update(connection.pieces)
+        updated = set()
+        for piece in redo:
+            label = pieceLabel(graph, piece, previous)
+            if labels.get(piece) != label:
+                if labels is rounds[-1]:
+                    if piece in labels:
+                        old.append(labels[piece])
+                    new.append(label)
+                labels[piece] = label
+                updated.add(piece)
+    return old, new
+
+#Returns the sum of the hashes of the labels, as an int below
+#LABEL_SUM_MODULUS.
+def labelsSum(labels):
+    total = sum(int(hashLabel(label), 16) for label in labels)
+    return total % LABEL_SUM_MODULUS
+
+#Returns the signature for a sum from labelsSum.
+def labelsDigest(labelSum):
+    return "%040x" % (labelSum % LABEL_SUM_MODULUS)
+
+#Returns a stable hex digest of the given label.
+def hashLabel(label):
+    return hashlib.sha1(repr(label).encode('utf-8')).hexdigest()
@@ -0,0 +1,122 @@
+import numpy as np
+import json
+
+""" NOTES
+    A catalog of target tangrams that a detected graph can be looked up in.
+    Each solution is stored as its graph signature plus a multiset of
+    features: one per piece name and one per connection, where a connection
+    feature is its type and the (name, location number) of both ends in a
+    fixed order, so it matches the way Connection.isSimilar compares them.
+
+    Exact matches are a dict lookup on the signature. Partial matches are
+    scored through an inverted index from each feature to the solutions
+    that contain it, so only solutions sharing a feature are touched.
+    """
+
+#Version of the files written by SolutionLibrary.save. Version 1 libraries
+#have signatures from before labels were summed, which match nothing now.
+LIBRARY_VERSION = 2
+
+#Returns the feature counts {feature: count} of the given graph.
+def graphFeatures(graph):
+    features = {}
+    for piece in graph.pieces:
+        feature = "piece " + piece.name
+        features[feature] = features.get(feature, 0) + 1
+    for connection in graph.connections:
+        ends = sorted([(connection.pieces[i].name, connection.locationNumbers[i])
+                       for i in range(2)])
+        feature = "connection %d %s:%s %s:%s" % (connection.connectionType,
+                    ends[0][0], ends[0][1], ends[1][0], ends[1][1])
+        features[feature] = features.get(feature, 0) + 1
+    return features
+
+class SolutionLibrary:
+
+    def __init__(self):
+        #One dict per solution with its name, signature and features.
+        self.solutions = []
+        #signature -> indexes of the solutions with that signature.
+        self.bySignature = {}
+        #feature -> ([solution indexes], [counts]) of the solutions with it.
+        self.postings = {}
+        #Total number of features of each solution.
+        self.sizes = []
+        #Postings as arrays, rebuilt after solutions are added.
+        self.postingArrays = None
+
+    def __len__(self):
+        return len(self.solutions)
+
+    #Adds the graph, usually from makeGraph, under the given name.
+    def addGraph(self, name, graph):
+        self.addSolution(name, graph.signature(), graphFeatures(graph))
+
+    def addSolution(self, name, signature, features):
+        index = len(self.solutions)
+        self.solutions.append({
+            "name": name,
+            "signature": signature,
+            "features": features
+        })
+        self.bySignature.setdefault(signature, []).append(index)
+        for feature in features:
+            indexes, counts = self.postings.setdefault(feature, ([], []))
+            indexes.append(index)
+            counts.append(features[feature])
+        self.sizes.append(sum(features.values()))
+        self.postingArrays = None
+
+    #Returns the names of the solutions with the same signature as graph.
+    def findExact(self, graph):
+        indexes = self.bySignature.get(graph.signature(), [])
+        return [self.solutions[i]["name"] for i in indexes]
+
+    #Returns up to count (score, name) pairs of the solutions most like the
+    #graph, best first. The score is the overlap of the feature multisets
+    #over their union, 1.0 for identical features.
+    def findNearest(self, graph, count = 5):
+        return self.findNearestFeatures(graphFeatures(graph), count)
+
+    def findNearestFeatures(self, features, count = 5):
+        if len(self.solutions) == 0:
+            return []
+        if self.postingArrays is None:
+            self.postingArrays = dict(
+                (feature, (np.asarray(indexes), np.asarray(counts)))
+                for feature, (indexes, counts) in self.postings.items())
+
+        overlap = np.zeros(len(self.solutions))
+        for feature in features:
+            if feature in self.postingArrays:
+                indexes, counts = self.postingArrays[feature]
+                overlap[indexes] += np.minimum(counts, features[feature])
+
+        union = np.asarray(self.sizes) + sum(features.values()) - overlap
+        scores = overlap / np.maximum(union, 1)
+        count = min(count, len(scores))
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best], kind='mergesort')]
+        return [(float(scores[i]), self.solutions[i]["name"])
+                for i in best if overlap[i] > 0]
+
+    def save(self, path):
+        outfile = open(path, 'w')
+        json.dump({"version": LIBRARY_VERSION, "solutions": self.solutions},
+                  outfile)
+        outfile.close()
+
+### Free Functions ###
+
+#Loads a library written by SolutionLibrary.save.
+def loadSolutionLibrary(path):
+    infile = open(path)
+    data = json.load(infile)
+    infile.close()
+    if data.get("version") != LIBRARY_VERSION:
+        raise ValueError('Unknown solution library version.')
+    library = SolutionLibrary()
+    for solution in data["solutions"]:
+        library.addSolution(solution["name"], solution["signature"],
+                            solution["features"])
+    return library
@@ -0,0 +1,188 @@
+import numpy as np
+import cv2
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from Tangrams import *
+from TangramsStats import RollingSamples, StageStats, getStats, setStats
+
+""" NOTES
+    Capture, detection and rendering run concurrently so a slow detection
+    frame never stalls the camera or the display:
+
+        capture thread -> frames -> detection workers -> results -> render
+
+    Both queues are bounded and drop their oldest item when full, so the
+    workers always pick up the newest frame and the render stage always
+    shows the newest result. cv2 releases the GIL in its heavy calls, so
+    the workers can run in parallel. Rendering stays on the thread that
+    calls run() because HighGUI windows must be used from a single thread.
+    """
+
+#Puts item in the bounded queue q, dropping the oldest item if it is full.
+#Returns the number of items dropped.
+def putLatest(q, item):
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+#One captured frame and everything found in it.
+class Frame:
+
+    def __init__(self, index, img):
+        self.index = index
+        self.img = img
+        self.captured = time.time()
+        self.pieces = []
+        self.connections = []
+        #The StageStats frame of the detection: the seconds, calls and
+        #counts of every instrumented stage it ran.
+        self.stats = None
+
+#Runs findValid, indentifyPieces and findConnections on the frame.
+def detectFrame(frame):
+    frame.pieces = indentifyPieces(findValid(frame.img), frame.img)
+    frame.connections = findConnections(frame.pieces)
+    return frame
+
+class DetectionPipeline:
+
+    def __init__(self, capture, workers = 2, queueSize = 2,
+                 detect = detectFrame):
+        #capture is anything with a cv2.VideoCapture style read().
+        self.capture = capture
+        self.detect = detect
+        self.frames = queue.Queue(queueSize)
+        self.results = queue.Queue(queueSize)
+        #Milliseconds of capture, waiting, rendering and end to end. The
+        #detection stages are timed by the active StageStats, one is set
+        #if there is none.
+        self.times = RollingSamples()
+        self.stats = getStats()
+        if self.stats is None:
+            self.stats = StageStats()
+            setStats(self.stats)
+        self.running = False
+        #Counts of dropped items, added to by every thread.
+        self.dropped = {"frames": 0, "results": 0, "stale": 0}
+        self.droppedLock = threading.Lock()
+        self.threads = [threading.Thread(target=self.captureLoop)]
+        for i in range(workers):
+            self.threads.append(threading.Thread(target=self.detectLoop))
+        for thread in self.threads:
+            thread.daemon = True
+        #Newest frame that has been rendered.
+        self.latest = None
+
+    def start(self):
+        self.running = True
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(1.0)
+
+    def captureLoop(self):
+        index = 0
+        while self.running:
+            start = time.time()
+            ret, img = self.capture.read()
+            if not ret:
+                self.running = False
+                break
+            self.times.add("capture", (time.time() - start) * 1000.0)
+            self.addDropped("frames", putLatest(self.frames,
+                                                Frame(index, img)))
+            index += 1
+
+    def detectLoop(self):
+        while self.running:
+            try:
+                frame = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.times.add("frame wait",
+                           (time.time() - frame.captured) * 1000.0)
+            self.detect(frame)
+            frame.stats = self.stats.endFrame()
+            self.addDropped("results", putLatest(self.results, frame))
+
+    #Adds count to the number of dropped items of the name, from any thread.
+    def addDropped(self, name, count):
+        if count:
+            with self.droppedLock:
+                self.dropped[name] += count
+
+    #Returns the newest detected frame, or None if there is nothing newer
+    #than the last one rendered. Older results are dropped.
+    def nextResult(self, timeout = 0.1):
+        newest = None
+        try:
+            newest = self.results.get(timeout=timeout)
+            while True:
+                frame = self.results.get_nowait()
+                if frame.index > newest.index:
+                    newest = frame
+        except queue.Empty:
+            pass
+        if newest is None:
+            return None
+        if self.latest is not None and newest.index < self.latest.index:
+            self.addDropped("stale", 1)
+            return None
+        return newest
+
+    #Renders results until the capture ends or onKey returns False.
+    #onKey is given the cv2.waitKey value and the newest rendered frame.
+    def run(self, onKey = None, reportEvery = 5.0):
+        self.start()
+        lastReport = time.time()
+        try:
+            while self.running or not self.results.empty():
+                frame = self.nextResult()
+                if frame is not None:
+                    start = time.time()
+                    renderFrame(frame)
+                    self.times.add("render", (time.time() - start) * 1000.0)
+                    self.times.add("end to end",
+                                   (time.time() - frame.captured) * 1000.0)
+                    self.latest = frame
+                key = cv2.waitKey(1) & 0xFF
+                if onKey is not None and onKey(key, self.latest) == False:
+                    break
+                if time.time() - lastReport > reportEvery:
+                    self.report()
+                    lastReport = time.time()
+        finally:
+            self.stop()
+        self.report()
+
+    def report(self):
+        with self.droppedLock:
+            dropped = dict(self.dropped)
+        print("\nDropped frames %(frames)d, results %(results)d, "
+              "stale %(stale)d" % dropped)
+        self.times.display()
+        self.stats.display()
+
+#Draws and displays the pieces and connections of the frame.
+def renderFrame(frame):
+    img = frame.img.copy()
+    blank = np.zeros(img.shape)
+    drawPieces(blank, frame.pieces)
+    drawConnections(img, frame.connections)
+    cv2.imshow('blank', blank)
+    cv2.imshow('frame', img)
@@ -0,0 +1,305 @@
+import numpy as np
+import cv2
+from Tangrams import *
+
+""" NOTES
+    Synthetic scenes of many tangram pieces with known answers. Pieces are
+    cut from a square lattice of side pixel cells, rotated as a whole:
+
+        square      one cell
+        triangles   one cell cut along a diagonal
+        strip       two cells cut into a triangle, a parallelogram with a
+                    45 degree angle and another triangle
+
+    Every side is moved gap / 2 pixels inwards, so pieces of the same
+    color don't merge, and each piece is filled with the middle of its color's
+    getColors range. The true pieces are Piece run on the exact corners
+    before rendering, listed in the order findValid would list them. The
+    true connections come from the lattice itself, not from the connection
+    code being tested: pieces that share a side of the lattice are
+    SIDE_SIDE on that side, and pieces that share only a corner are
+    POINT_POINT at that corner. The lattice has no corner in the middle of
+    a side, so there are no true SIDE_POINT connections. A detector is right
+    when it finds the same pieces, names, connections and location numbers
+    from the image.
+    """
+
+#Background gray, outside every getColors range.
+BACKGROUND = (230, 230, 230)
+
+#A generated image and the pieces and connections it should give.
+class Scene:
+
+    def __init__(self, img, contours, colors, names, corners):
+        self.img = img
+        #Exact corners of each piece as int32 contours, like findValid's.
+        self.contours = contours
+        self.colors = colors
+        #Names the pieces were built as.
+        self.names = names
+        #The lattice points of each contour's corners, in the same order.
+        self.corners = corners
+        self.pieces = [Piece(contour) for contour in contours]
+        self.connections = latticeConnections(self.pieces, corners)
+
+    #Returns how the detected pieces and connections compare to the truth,
+    #see matchPieces and matchConnections.
+    def score(self, pieces, connections):
+        matches = matchPieces(self.pieces, pieces)
+        result = matchConnections(self.connections, self.pieces, connections,
+                                  pieces, matches)
+        result["pieces"] = len(self.pieces)
+        result["found"] = len(matches)
+        result["missing"] = len(self.pieces) - len(matches)
+        result["extra"] = len(pieces) - len(matches)
+        result["wrongNames"] = sum(self.pieces[i].name != pieces[j].name
+                                   for i, j in matches.items())
+        return result
+
+### Free Functions ###
+
+#Returns a random Scene of width x height pixels with count pieces from
+#cells side pixels across, or as many as fit when count is None. noise is
+#the deviation of gaussian noise added to the image.
+def makeScene(width = 640, height = 480, count = None, side = 60, gap = 6,
+              noise = 0.0, seed = 0):
+    rng = np.random.RandomState(seed)
+    polygons, names, lattice = latticePieces(rng, width, height, side)
+    polygons = [inset(polygon, gap / 2.0) for polygon in polygons]
+
+    #Keeps the pieces that are fully inside the frame, with a margin.
+    margin = 2 + gap
+    inside = [i for i, polygon in enumerate(polygons)
+              if polygon[:, 0].min() >= margin
+              and polygon[:, 1].min() >= margin
+              and polygon[:, 0].max() < width - margin
+              and polygon[:, 1].max() < height - margin]
+    if count is not None:
+        if count > len(inside):
+            raise ValueError('Only %d pieces fit, use a larger image or a '
+                             'smaller side.' % len(inside))
+        inside = sorted(rng.choice(inside, count, replace=False))
+
+    high, low = getColors(None)
+    palette = dict((color, tuple(int((high[color][c] + low[color][c]) // 2)
+                                 for c in range(3)))
+                   for color in high)
+    colorNames = sorted(palette)
+
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = BACKGROUND
+    contours = []
+    colors = []
+    corners = []
+    for i in inside:
+        order = detectorOrder(polygons[i])
+        contour = np.int32(np.round(polygons[i][order])).reshape(-1, 1, 2)
+        color = colorNames[rng.randint(len(colorNames))]
+        cv2.fillPoly(img, [contour], palette[color])
+        contours.append(contour)
+        colors.append(color)
+        corners.append([lattice[i][k] for k in order])
+    if noise > 0:
+        img = np.clip(img + rng.normal(0, noise, img.shape), 0,
+                      255).astype(np.uint8)
+    return Scene(img, contours, colors, [names[i] for i in inside], corners)
+
+#Returns the corners, names and lattice corners of the pieces cut from a
+#randomly rotated lattice of side pixel cells that covers the frame. The
+#lattice corners are (column, row) pairs of ints, the same for every piece
+#that has a corner at that point.
+def latticePieces(rng, width, height, side):
+    #Enough cells to cover the frame at any angle.
+    cells = int(np.ceil(np.hypot(width, height) / side)) + 2
+    angle = rng.uniform(0, np.pi / 2)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                         [np.sin(angle), np.cos(angle)]])
+    center = np.array([width / 2.0, height / 2.0])
+
+    polygons = []
+    names = []
+    lattice = []
+    for row in range(cells):
+        col = 0
+        while col < cells:
+            x, y = col - cells / 2.0, row - cells / 2.0
+            kind = rng.randint(4) if col + 1 < cells else rng.randint(3)
+            if kind == 0:
+                cut = [("square", [[0, 0], [1, 0], [1, 1], [0, 1]])]
+            elif kind == 1:
+                cut = [("triangle", [[0, 0], [1, 0], [0, 1]]),
+                       ("triangle", [[1, 0], [1, 1], [0, 1]])]
+            elif kind == 2:
+                cut = [("triangle", [[0, 0], [1, 0], [1, 1]]),
+                       ("triangle", [[0, 0], [1, 1], [0, 1]])]
+            else:
+                cut = [("triangle", [[0, 0], [1, 1], [0, 1]]),
+                       ("parallelogram", [[0, 0], [1, 0], [2, 1], [1, 1]]),
+                       ("triangle", [[1, 0], [2, 0], [2, 1]])]
+            for name, corners in cut:
+                lattice.append([(col + cx, row + cy) for cx, cy in corners])
+                corners = (np.array(corners, dtype=np.float64) + [x, y]) * side
+                polygons.append(np.dot(corners, rotation.T) + center)
+                names.append(name)
+            col += 2 if kind == 3 else 1
+    return polygons, names, lattice
+
+#Moves every side of the convex polygon distance pixels inwards.
+def inset(polygon, distance):
+    following = np.roll(polygon, -1, axis=0)
+    sides = following - polygon
+    sides /= np.sqrt((sides * sides).sum(axis=1))[:, None]
+    #Inward normal of each side, for corners in clockwise order on screen.
+    normals = np.stack([-sides[:, 1], sides[:, 0]], axis=1)
+    if polygonArea(polygon) < 0:
+        normals = -normals
+    previous = np.roll(normals, 1, axis=0)
+    #Where the moved sides before and after each corner meet.
+    dots = (normals * previous).sum(axis=1)[:, None]
+    return polygon + distance * (normals + previous) / (1 + dots)
+
+#Returns the signed area of the polygon, positive for corners in clockwise
+#order on screen.
+def polygonArea(polygon):
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * (x * np.roll(y, -1) - np.roll(x, -1) * y).sum()
+
+#Returns the order of the corners in which findValid lists the corners of
+#the same piece, which the location numbers depend on. The piece is drawn
+#alone and its corners are matched to the ones findContours and
+#approxPolyDP find. The order is unchanged if they can't be matched.
+def detectorOrder(corners):
+    unchanged = np.arange(len(corners))
+    contour = np.int32(np.round(corners))
+    x, y, w, h = cv2.boundingRect(contour)
+    mask = np.zeros((h + 2, w + 2), dtype=np.uint8)
+    cv2.fillPoly(mask, [contour - [x - 1, y - 1]], 255)
+    _, found, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL,
+                                   cv2.CHAIN_APPROX_SIMPLE)
+    if len(found) != 1:
+        return unchanged
+    eps = 0.05 * cv2.arcLength(found[0], True)
+    detected = cv2.approxPolyDP(found[0], eps, True).reshape(-1, 2)
+    detected = detected + [x - 1, y - 1]
+    if len(detected) != len(corners):
+        return unchanged
+    distances = ((detected[:, None, :] - corners[None, :, :]) ** 2).sum(axis=2)
+    order = distances.argmin(axis=1)
+    if len(set(order)) != len(corners):
+        return unchanged
+    return order
+
+#Returns the connections between the pieces given by the lattice corners of
+#each, see latticePieces, ordered by first then second piece like
+#findConnections'. Two pieces that share two lattice points share the side
+#between them, since the pieces are convex and don't overlap.
+def latticeConnections(pieces, corners):
+    #Lattice point -> (piece index, corner index) of every piece at it.
+    owners = {}
+    for n, pieceCorners in enumerate(corners):
+        for k, point in enumerate(pieceCorners):
+            owners.setdefault(point, []).append((n, k))
+    #(piece index, other piece index) -> corner index pairs they share.
+    shared = {}
+    for atPoint in owners.values():
+        for n, k in atPoint:
+            for m, l in atPoint:
+                if n < m:
+                    shared.setdefault((n, m), []).append((k, l))
+
+    connections = []
+    for n, m in sorted(shared):
+        first, second = pieces[n], pieces[m]
+        pairs = shared[(n, m)]
+        connection = Connection(first, second, False)
+        if len(pairs) == 2:
+            (k1, l1), (k2, l2) = pairs
+            connection.setContacts(SIDE_SIDE,
+                first.sides[sideBetween(k1, k2, len(corners[n]))],
+                second.sides[sideBetween(l1, l2, len(corners[m]))])
+        else:
+            k, l = pairs[0]
+            connection.setContacts(POINT_POINT, first.contour[k],
+                                   second.contour[l])
+        connections.append(connection)
+    return connections
+
+#Returns the index of the side between corners k1 and k2 of a piece with
+#count corners, side i going from corner i to corner i + 1.
+def sideBetween(k1, k2, count):
+    if (k1 + 1) % count == k2:
+        return k1
+    if (k2 + 1) % count == k1:
+        return k2
+    raise ValueError('The corners are not next to each other.')
+
+#Returns {truth index: found index} pairing every true piece with the
+#closest unpaired found piece whose center is within maxDist pixels.
+def matchPieces(truth, found, maxDist = MIN_DUPLICATE_DIST):
+    if len(truth) == 0 or len(found) == 0:
+        return {}
+    a = np.array([piece.center for piece in truth])
+    b = np.array([piece.center for piece in found])
+    distances = np.sqrt(((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2))
+    matches = {}
+    used = set()
+    for flat in np.argsort(distances, axis=None):
+        i, j = np.unravel_index(flat, distances.shape)
+        if distances[i, j] >= maxDist:
+            break
+        if i not in matches and j not in used:
+            matches[i] = j
+            used.add(j)
+    return matches
+
+#Returns the counts of true connections found with the same type and
+#location numbers ("correct"), found with a different type or location
+#numbers ("wrong") and not found ("missed"), and of found connections
+#between pieces that shouldn't connect ("extraConnections"). matches is
+#from matchPieces(truthPieces, foundPieces).
+def matchConnections(truth, truthPieces, found, foundPieces, matches):
+    #(first piece, second piece) -> found connection, both ways round.
+    byPair = {}
+    for connection in found:
+        first, second = [id(piece) for piece in connection.pieces]
+        byPair[(first, second)] = (connection, False)
+        byPair[(second, first)] = (connection, True)
+    truthIndex = dict((id(piece), i) for i, piece in enumerate(truthPieces))
+
+    result = {"connections": len(truth), "correct": 0, "wrong": 0,
+              "missed": 0}
+    used = set()
+    for connection in truth:
+        pair = [matches.get(truthIndex[id(piece)])
+                for piece in connection.pieces]
+        if None in pair:
+            result["missed"] += 1
+            continue
+        match = byPair.get((id(foundPieces[pair[0]]),
+                            id(foundPieces[pair[1]])))
+        if match is None:
+            result["missed"] += 1
+            continue
+        other, flipped = match
+        used.add(id(other))
+        numbers = list(other.locationNumbers)
+        if flipped:
+            numbers.reverse()
+        if (other.connectionType == connection.connectionType
+                and numbers == list(connection.locationNumbers)):
+            result["correct"] += 1
+        else:
+            result["wrong"] += 1
+    result["extraConnections"] = len(found) - len(used)
+    return result
+
+#Returns one piece of each kind, not detected from any image, to copy from
+#when building graphs by hand.
+def templatePieces():
+    contours = {
+        "square": [[0, 0], [100, 0], [100, 100], [0, 100]],
+        "triangle": [[0, 0], [100, 0], [0, 100]],
+        "parallelogram": [[0, 0], [100, 0], [150, 50], [50, 50]]
+    }
+    return dict((name, Piece(np.int32(contours[name]).reshape(-1, 1, 2)))
+                for name in contours)
@@ -0,0 +1,160 @@
+import cv2
+import glob
+import os
+import time
+from Tangrams import *
+
+""" NOTES
+    Frame sources for detection. Every source has the cv2.VideoCapture
+    style read() and release() that DetectionPipeline and vidTest use:
+    read() returns (True, img) for the next frame or (False, None) at the
+    end, and release() frees the camera or file. A FrameSource subclass
+    defines read() and gets a release() that does nothing unless it defines
+    its own. Iterating over a source yields its frames until it runs out:
+
+        for pieces, connections in detectFrames(openSource("session.avi")):
+            ...
+
+    Files, directories and generators are read as fast as they are asked
+    for, not at the speed they were recorded, so a recorded session can be
+    replayed as fast as detection runs. measureThroughput does that and
+    returns the frames per second.
+    """
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+class FrameSource:
+
+    def release(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            ret, img = self.read()
+            if not ret:
+                return
+            yield img
+
+class CameraSource(FrameSource):
+
+    def __init__(self, index = 0):
+        self.capture = cv2.VideoCapture(index)
+
+    def read(self):
+        return self.capture.read()
+
+    def release(self):
+        self.capture.release()
+
+class VideoFileSource(FrameSource):
+
+    def __init__(self, path, loop = False):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError("Could not open " + path)
+        self.loop = loop
+
+    def read(self):
+        ret, img = self.capture.read()
+        if not ret and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, img = self.capture.read()
+        return ret, img
+
+    def release(self):
+        self.capture.release()
+
+#The images of a directory in name order, like frames saved from a session.
+class DirectorySource(FrameSource):
+
+    def __init__(self, path, loop = False, preload = False):
+        """ NOTES
+            preload reads every image up front, so replays measure the
+            detection and not the disk and the image decoder.
+            """
+        self.filenames = findImages([path])
+        if len(self.filenames) == 0:
+            raise IOError("No images in " + path)
+        self.loop = loop
+        self.images = None
+        if preload:
+            self.images = [self.load(filename) for filename in self.filenames]
+        self.index = 0
+
+    def load(self, filename):
+        img = cv2.imread(filename, 1)
+        if img is None:
+            raise IOError("Could not read " + filename)
+        return img
+
+    def read(self):
+        if self.index >= len(self.filenames):
+            if not self.loop:
+                return False, None
+            self.index = 0
+        if self.images is not None:
+            img = self.images[self.index]
+        else:
+            img = self.load(self.filenames[self.index])
+        self.index += 1
+        return True, img
+
+#Frames from any iterable of images, like a list or a generator of
+#TangramsScenes images.
+class GeneratorSource(FrameSource):
+
+    def __init__(self, frames):
+        self.frames = iter(frames)
+
+    def read(self):
+        for img in self.frames:
+            return True, img
+        return False, None
+
+### Free Functions ###
+
+#Returns the source named by spec: a camera index like 1, a directory of
+#frames or a video file.
+def openSource(spec, loop = False):
+    if isinstance(spec, int) or spec.isdigit():
+        return CameraSource(int(spec))
+    if os.path.isdir(spec):
+        return DirectorySource(spec, loop)
+    return VideoFileSource(spec, loop)
+
+#Returns the sorted image files named by files, directories or globs.
+def findImages(inputs):
+    filenames = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for filename in glob.glob(pattern):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                filenames.add(filename)
+    return sorted(filenames)
+
+#Returns the pieces and connections of the image.
+def detectImage(img):
+    pieces = indentifyPieces(findValid(img), img)
+    return pieces, findConnections(pieces)
+
+#Yields detect(img) for every frame, as soon as the last one is done.
+def detectFrames(frames, detect = detectImage):
+    for img in frames:
+        yield detect(img)
+
+#Runs detect on up to limit frames of the source as fast as it can and
+#returns (frames, seconds, frames per second). onResult, if given, is called
+#with every result.
+def measureThroughput(source, detect = detectImage, limit = None,
+                      onResult = None):
+    count = 0
+    start = time.time()
+    for result in detectFrames(source, detect):
+        count += 1
+        if onResult is not None:
+            onResult(result)
+        if limit is not None and count >= limit:
+            break
+    seconds = time.time() - start
+    return count, seconds, count / max(seconds, 1e-9)
@@ -0,0 +1,256 @@
+import numpy as np
+import mmap
+import os
+import struct
+from Tangrams import *
+from TangramsGraph import makeGraph
+
+""" NOTES
+    Binary recordings of the pieces and connections detected in each frame.
+    A file is a header followed by one record per frame, only ever appended
+    to:
+
+        header      "TGRS", version (uint16), unused (uint16)
+        record      pieces, vertices, connections (uint32 each), then
+                    PIECE_DTYPE * pieces, VERTEX_DTYPE * vertices and
+                    CONNECTION_DTYPE * connections
+
+    Everything is little endian. A piece's vertices follow the vertices of
+    the pieces before it. The contacts of a connection are the index of the
+    side or contour point of each piece that touches, with SIDE_CONTACT set
+    for sides, so reading a frame back gives the same pieces, touching sides
+    and points and location numbers that were written.
+
+    StateReader maps the file and finds where each record starts, so any
+    frame can be read without reading the ones before it. A record cut off
+    by a crash is ignored, and StateWriter cuts it off before appending.
+    """
+
+MAGIC = b"TGRS"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+RECORD_HEADER = struct.Struct("<III")
+
+#Piece names and spins by their code in the file.
+NAMES = ["NON_PIECE", "square", "parallelogram", "triangle"]
+SPINS = [None, "CW", "CCW"]
+#Stands for None in the int8 rcIndex and location number fields.
+NONE_NUMBER = -128
+#Most vertices a piece can have. A contact is one byte with SIDE_CONTACT as
+#the side flag, so point and side indexes must be below it.
+MAX_VERTICES = SIDE_CONTACT
+
+PIECE_DTYPE = np.dtype([("name", "u1"), ("spin", "u1"), ("rcIndex", "i1"),
+                        ("vertices", "u1"), ("trackId", "<i4"),
+                        ("center", "<f8", (2,)), ("theta", "<f8")])
+VERTEX_DTYPE = np.dtype([("x", "<i4"), ("y", "<i4")])
+CONNECTION_DTYPE = np.dtype([("type", "i1"), ("first", "<u4"),
+                             ("second", "<u4"), ("contacts", "u1", (2,)),
+                             ("locations", "i1", (2,))])
+
+#Appends frames to a state file, creating it if needed.
+class StateWriter:
+
+    def __init__(self, path):
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.outfile = open(path, 'r+b')
+            data = mmap.mmap(self.outfile.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+            try:
+                offsets, end = scanRecords(data)
+            finally:
+                data.close()
+            #Drops a record cut off by a crash.
+            self.outfile.truncate(end)
+            self.outfile.seek(end)
+            self.frames = len(offsets)
+        else:
+            self.outfile = open(path, 'wb')
+            self.outfile.write(HEADER.pack(MAGIC, VERSION, 0))
+            self.frames = 0
+
+    #Appends a frame and returns its index. Every piece of the connections
+    #must be in pieces.
+    def write(self, pieces, connections):
+        self.outfile.write(encodeFrame(pieces, connections))
+        self.frames += 1
+        return self.frames - 1
+
+    def flush(self):
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+#Reads the frames of a state file by index.
+class StateReader:
+
+    def __init__(self, path):
+        self.infile = open(path, 'rb')
+        if os.path.getsize(path) < HEADER.size:
+            self.infile.close()
+            raise ValueError('Not a state file: ' + path)
+        self.data = mmap.mmap(self.infile.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        self.offsets = scanRecords(self.data)[0]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.read(index)
+
+    #Returns the piece, vertex and connection arrays of a frame, read only
+    #views of the file with the dtypes above.
+    def readArrays(self, index):
+        if index < 0:
+            index += len(self.offsets)
+        if not 0 <= index < len(self.offsets):
+            raise IndexError('Frame index out of range.')
+        offset = self.offsets[index]
+        counts = RECORD_HEADER.unpack_from(self.data, offset)
+        offset += RECORD_HEADER.size
+        arrays = []
+        for dtype, count in zip([PIECE_DTYPE, VERTEX_DTYPE, CONNECTION_DTYPE],
+                                counts):
+            arrays.append(np.frombuffer(self.data, dtype, count, offset))
+            offset += dtype.itemsize * count
+        return arrays
+
+    #Returns the pieces and connections of a frame.
+    def read(self, index):
+        return decodeFrame(*self.readArrays(index))
+
+    #Returns the TangramsGraph of a frame.
+    def readGraph(self, index):
+        return makeGraph(*self.read(index))
+
+    def close(self):
+        self.data.close()
+        self.infile.close()
+
+### Free Functions ###
+
+#Returns the start of every complete record in data, a state file's bytes,
+#and the end of the last one.
+def scanRecords(data):
+    magic, version, unused = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a state file.')
+    if version != VERSION:
+        raise ValueError('Unknown state file version.')
+    offsets = []
+    offset = HEADER.size
+    while offset + RECORD_HEADER.size <= len(data):
+        pieces, vertices, connections = RECORD_HEADER.unpack_from(data,
+                                                                  offset)
+        end = (offset + RECORD_HEADER.size + PIECE_DTYPE.itemsize * pieces
+               + VERTEX_DTYPE.itemsize * vertices
+               + CONNECTION_DTYPE.itemsize * connections)
+        if end > len(data):
+            break
+        offsets.append(offset)
+        offset = end
+    return offsets, offset
+
+#Returns the bytes of one record.
+def encodeFrame(pieces, connections):
+    indexes = {}
+    #id(piece) -> {vertex: index of its first copy in the contour}.
+    vertexIndexes = {}
+    contours = []
+    for i, piece in enumerate(pieces):
+        indexes[id(piece)] = i
+        contour = piece.contour.reshape(-1, 2)
+        if piece.name not in NAMES or len(contour) > MAX_VERTICES:
+            raise ValueError('Cannot write piece ' + str(piece.name)
+                             + ' with ' + str(len(contour)) + ' vertices.')
+        first = {}
+        for k, vertex in enumerate(contour.tolist()):
+            first.setdefault(tuple(vertex), k)
+        vertexIndexes[id(piece)] = first
+        contours.append(contour)
+
+    pieceArray = np.zeros(len(pieces), PIECE_DTYPE)
+    if len(pieces) > 0:
+        pieceArray["name"] = [NAMES.index(piece.name) for piece in pieces]
+        pieceArray["spin"] = [SPINS.index(piece.spin) for piece in pieces]
+        pieceArray["rcIndex"] = [orNone(piece.rcIndex) for piece in pieces]
+        pieceArray["vertices"] = [len(contour) for contour in contours]
+        pieceArray["trackId"] = [-1 if piece.trackId is None
+                                 else piece.trackId for piece in pieces]
+        pieceArray["center"] = [piece.center for piece in pieces]
+        pieceArray["theta"] = [np.nan if piece.theta is None else piece.theta
+                               for piece in pieces]
+        vertexArray = np.concatenate(contours).astype("<i4")
+    else:
+        vertexArray = np.zeros((0, 2), "<i4")
+
+    connectionArray = np.zeros(len(connections), CONNECTION_DTYPE)
+    if len(connections) > 0:
+        try:
+            pairs = [[indexes[id(piece)] for piece in connection.pieces]
+                     for connection in connections]
+        except KeyError:
+            raise ValueError('A connection joins a piece that is not in '
+                             'pieces.')
+        connectionArray["type"] = [connection.connectionType
+                                   for connection in connections]
+        connectionArray["first"], connectionArray["second"] = zip(*pairs)
+        connectionArray["contacts"] = [
+            connectionContacts(connection, vertexIndexes)
+            for connection in connections]
+        connectionArray["locations"] = [
+            [orNone(number) for number in connection.locationNumbers]
+            for connection in connections]
+
+    return (RECORD_HEADER.pack(len(pieceArray), len(vertexArray),
+                               len(connectionArray))
+            + pieceArray.tobytes() + vertexArray.tobytes()
+            + connectionArray.tobytes())
+
+#Returns the pieces and connections of a record's arrays.
+def decodeFrame(pieceArray, vertexArray, connectionArray):
+    #One copy for the contours of every piece, so they outlive the file.
+    vertices = vertexArray.view("<i4").reshape(-1, 2).astype(np.int32)
+    counts = pieceArray["vertices"].tolist()
+    ends = np.cumsum(counts).tolist()
+    names = pieceArray["name"].tolist()
+    spins = pieceArray["spin"].tolist()
+    rcIndexes = pieceArray["rcIndex"].tolist()
+    trackIds = pieceArray["trackId"].tolist()
+    centers = pieceArray["center"].tolist()
+    thetas = pieceArray["theta"].tolist()
+    pieces = []
+    for i in range(len(pieceArray)):
+        contour = vertices[ends[i] - counts[i]:ends[i]].reshape(-1, 1, 2)
+        theta = None if np.isnan(thetas[i]) else thetas[i]
+        shape = (NAMES[names[i]], theta, SPINS[spins[i]],
+                 fromNone(rcIndexes[i]))
+        piece = Piece(contour, tuple(centers[i]), shape)
+        if trackIds[i] >= 0:
+            piece.trackId = trackIds[i]
+        pieces.append(piece)
+
+    #Columns as lists of Python ints, since the fields of a row of
+    #subarrays stay numpy arrays whose uint8 math can overflow.
+    columns = [connectionArray[field].tolist()
+               for field in CONNECTION_DTYPE.names]
+    connections = []
+    for connectionType, first, second, contacts, locations in zip(*columns):
+        piece1 = pieces[first]
+        piece2 = pieces[second]
+        connection = Connection(piece1, piece2, False)
+        connection.setContacts(connectionType,
+                               contactOf(piece1, contacts[0]),
+                               contactOf(piece2, contacts[1]),
+                               [fromNone(number) for number in locations])
+        connections.append(connection)
+    return pieces, connections
+
+def orNone(number):
+    return NONE_NUMBER if number is None else number
+
+def fromNone(number):
+    return None if number == NONE_NUMBER else int(number)
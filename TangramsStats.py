@@ -0,0 +1,157 @@
+import numpy as np
+import functools
+import threading
+import time
+
+""" NOTES
+    Stage instrumentation for the detection functions. Functions marked with
+    @instrument report their wall time, and the length of their result if
+    it is counted, to the StageStats given to setStats:
+
+        stats = StageStats()
+        setStats(stats)
+        ...detect a frame...
+        frame = stats.endFrame()
+        frame["times"]["findValid"], frame["counts"]["pieces"]
+
+    With no StageStats set, the only cost of a marked function is one extra
+    call and a check for None. Stages nest, findValid's time includes the
+    findBlocks and reduceToBlocks calls it makes.
+    """
+
+#The StageStats that marked functions report to, or None.
+activeStats = None
+
+def setStats(stats):
+    global activeStats
+    activeStats = stats
+
+def getStats():
+    return activeStats
+
+#Marks a function as a stage. counted names the count the length of its
+#result is added to, like "pieces".
+def instrument(stage, counted = None):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stats = activeStats
+            if stats is None:
+                return function(*args, **kwargs)
+            start = time.time()
+            result = function(*args, **kwargs)
+            stats.record(stage, time.time() - start, counted, result)
+            return result
+        return wrapper
+    return decorate
+
+#Keeps the latest samples of each stage or count, from any thread.
+class RollingSamples:
+
+    def __init__(self, size = 300):
+        self.size = size
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value):
+        with self.lock:
+            samples = self.samples.setdefault(name, [])
+            samples.append(value)
+            if len(samples) > self.size:
+                del samples[0]
+
+    #Returns a copy of the latest samples of the name.
+    def get(self, name):
+        with self.lock:
+            return list(self.samples.get(name, []))
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.samples
+
+    #Returns the names with samples, sorted.
+    def names(self):
+        with self.lock:
+            return sorted(self.samples)
+
+    #Returns {name: (median, p95, count)} of the latest samples.
+    def summary(self):
+        with self.lock:
+            return dict((name, (np.median(samples),
+                                np.percentile(samples, 95),
+                                len(samples)))
+                        for name, samples in self.samples.items())
+
+    #Prints the summary of samples in milliseconds.
+    def display(self):
+        summary = self.summary()
+        for name in sorted(summary):
+            median, p95, count = summary[name]
+            print("%-16s median %7.2f ms  p95 %7.2f ms  (%d)"
+                  % (name, median, p95, count))
+
+#Per-frame stage times, calls and counts, and the latest frames of each.
+class StageStats:
+
+    def __init__(self, size = 300):
+        """ NOTES
+            Each thread builds its own frame, so detection workers running at
+            the same time don't mix their frames. endFrame adds the frame to
+            the rolling samples, which keep the last size frames of every
+            stage and count for summary and histogram.
+            """
+        self.local = threading.local()
+        #Milliseconds per frame of each stage and each count per frame.
+        self.times = RollingSamples(size)
+        self.counts = RollingSamples(size)
+        self.frames = 0
+        self.lock = threading.Lock()
+
+    #Returns the frame being built by this thread.
+    def currentFrame(self):
+        frame = getattr(self.local, "frame", None)
+        if frame is None:
+            frame = {"times": {}, "calls": {}, "counts": {}}
+            self.local.frame = frame
+        return frame
+
+    def record(self, stage, seconds, counted = None, result = None):
+        frame = self.currentFrame()
+        frame["times"][stage] = frame["times"].get(stage, 0.0) + seconds
+        frame["calls"][stage] = frame["calls"].get(stage, 0) + 1
+        if counted is not None:
+            self.count(counted, len(result))
+
+    def count(self, name, number):
+        counts = self.currentFrame()["counts"]
+        counts[name] = counts.get(name, 0) + number
+
+    #Finishes this thread's frame and returns it as a dict of "times" in
+    #seconds, "calls" and "counts", each by stage or count name.
+    def endFrame(self):
+        frame = self.currentFrame()
+        self.local.frame = None
+        with self.lock:
+            self.frames += 1
+        for stage in frame["times"]:
+            self.times.add(stage, frame["times"][stage] * 1000.0)
+        for name in frame["counts"]:
+            self.counts.add(name, frame["counts"][name])
+        return frame
+
+    #Returns {stage: (median, p95, frames)} of the milliseconds per frame.
+    def summary(self):
+        return self.times.summary()
+
+    #Returns the (counts, bin edges) of the latest milliseconds per frame of
+    #a stage, or of the latest values of a count like "pieces".
+    def histogram(self, name, bins = 10):
+        if name in self.times:
+            return np.histogram(self.times.get(name), bins)
+        return np.histogram(self.counts.get(name), bins)
+
+    def display(self):
+        self.times.display()
+        for name in self.counts.names():
+            print("%-16s mean %7.1f per frame" % (name,
+                  np.mean(self.counts.get(name))))
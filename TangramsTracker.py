@@ -0,0 +1,138 @@
+import numpy as np
+import cv2
+from Tangrams import *
+
+#Largest distance in pixels a piece's center can move between frames and
+#still be matched to the same piece.
+MAX_TRACK_DIST = 40
+#Largest relative change in area for a match.
+MAX_TRACK_AREA_CHANGE = 0.25
+#Pieces whose vertices all moved less than this many pixels are kept as they
+#were, with their geometry and connections.
+MAX_STILL_DIST = 4
+
+class PieceTracker:
+
+    def __init__(self, maxTrackDist = MAX_TRACK_DIST,
+                 maxStillDist = MAX_STILL_DIST, cache = None):
+        """ NOTES
+            Every frame's contours are matched to the pieces of the frame
+            before by center, number of vertices and area. A matched piece
+            that hasn't moved keeps its Piece object, so its sides, angles
+            and theta aren't computed again, and connections between two
+            pieces that didn't move are reused. Only pairs with a new or
+            moved piece go through the connection tests, through cache if
+            it is given, a Tangrams.ConnectionCache.
+            """
+        self.maxTrackDist = maxTrackDist
+        self.maxStillDist = maxStillDist
+        self.cache = cache
+        self.pieces = []
+        self.connections = []
+        self.nextId = 0
+        #Number of pieces rebuilt and reused by the last update.
+        self.moved = 0
+        self.still = 0
+
+    #Returns the pieces and connections for the contours of a new frame,
+    #like indentifyPieces followed by findConnections. The pieces are sorted
+    #by trackId.
+    def update(self, contours):
+        matches = self.matchContours(contours)
+
+        pieces = []
+        moved = set()
+        for index, contour in enumerate(contours):
+            previous = matches.get(index)
+            if previous is not None and self.isStill(previous, contour):
+                pieces.append(previous)
+                continue
+            piece = Piece(contour)
+            if previous is not None:
+                piece.trackId = previous.trackId
+            else:
+                piece.trackId = self.nextId
+                self.nextId += 1
+            pieces.append(piece)
+            moved.add(piece.trackId)
+        pieces.sort(key=lambda piece: piece.trackId)
+
+        self.connections = self.updateConnections(pieces, moved)
+        self.pieces = pieces
+        self.moved = len(moved)
+        self.still = len(pieces) - len(moved)
+        return self.pieces, self.connections
+
+    #Returns {contour index: previous piece} pairing each contour with the
+    #closest unclaimed piece of the last frame that looks the same.
+    def matchContours(self, contours):
+        matches = {}
+        if len(contours) == 0 or len(self.pieces) == 0:
+            return matches
+        centers = np.asarray([getCenter(contour) for contour in contours])
+        areas = np.asarray([cv2.contourArea(contour) for contour in contours])
+        sizes = np.asarray([len(contour) for contour in contours])
+        oldCenters = np.asarray([piece.center for piece in self.pieces])
+        oldAreas = np.asarray([cv2.contourArea(piece.contour)
+                               for piece in self.pieces])
+        oldSizes = np.asarray([len(piece.contour) for piece in self.pieces])
+
+        offsets = centers[:, None, :] - oldCenters[None, :, :]
+        distances = np.sqrt((offsets * offsets).sum(axis=2))
+        areaChange = (np.abs(areas[:, None] - oldAreas[None, :])
+                      / np.maximum(oldAreas[None, :], 1))
+        possible = ((distances < self.maxTrackDist)
+                  & (areaChange < MAX_TRACK_AREA_CHANGE)
+                  & (sizes[:, None] == oldSizes[None, :]))
+
+        #Closest pairs first, each contour and piece used once.
+        new, old = np.nonzero(possible)
+        claimed = set()
+        for k in np.argsort(distances[new, old], kind='mergesort'):
+            if new[k] in matches or old[k] in claimed:
+                continue
+            matches[new[k]] = self.pieces[old[k]]
+            claimed.add(old[k])
+        return matches
+
+    #Returns true if every vertex of the contour is within maxStillDist of a
+    #vertex of the piece and the other way around. Doesn't depend on which
+    #vertex the contour starts at.
+    def isStill(self, piece, contour):
+        offsets = (contour.reshape(-1, 1, 2).astype(float)
+                 - piece.contour.reshape(1, -1, 2))
+        distances = np.sqrt((offsets * offsets).sum(axis=2))
+        return(     distances.min(axis=1).max() < self.maxStillDist
+                and distances.min(axis=0).max() < self.maxStillDist )
+
+    #Keeps the connections between pieces that didn't move and finds the
+    #connections of every pair with a moved piece.
+    def updateConnections(self, pieces, moved):
+        kept = {}
+        for connection in self.connections:
+            ids = tuple(piece.trackId for piece in connection.pieces)
+            if ids[0] not in moved and ids[1] not in moved:
+                kept[ids] = connection
+
+        first, second = findCandidatePairs(pieces)
+        connections = {}
+        if len(first) > 0:
+            ids = np.asarray([piece.trackId for piece in pieces])
+            changed = np.asarray([piece.trackId in moved for piece in pieces])
+            redo = changed[first] | changed[second]
+            if self.cache is not None:
+                found = self.cache.connectPairs(pieces, first[redo],
+                                                second[redo], True)
+            else:
+                found = determineConnectionTypes(pieces, first[redo],
+                                                 second[redo])
+            for connection in found:
+                connections[tuple(piece.trackId
+                                  for piece in connection.pieces)] = connection
+            for i, j in zip(first[~redo], second[~redo]):
+                key = (ids[i], ids[j])
+                if key in kept:
+                    connections[key] = kept[key]
+
+        #Same order findConnections gives for pieces sorted by trackId.
+        return [connections[key] for key in sorted(connections)]
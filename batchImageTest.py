@@ -0,0 +1,127 @@
+import argparse
+import cv2
+import json
+import multiprocessing
+import sys
+import time
+from Tangrams import *
+from TangramsGraph import *
+from TangramsSources import findImages
+
+#Graph of the --target image, built once in each worker process.
+targetGraph = None
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the pieces and connections of many tangram images.")
+    parser.add_argument("inputs", nargs="+",
+                        help="image files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default="-",
+                        help="JSONL file to write, - for stdout")
+    parser.add_argument("-w", "--workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("-t", "--target",
+                        help="image of the solution to compare every graph to")
+    args = parser.parse_args()
+
+    filenames = findImages(args.inputs)
+    if len(filenames) == 0:
+        print("No images found")
+        sys.exit(1)
+
+    if args.output == "-":
+        outfile = sys.stdout
+    else:
+        outfile = open(args.output, 'w')
+
+    start = time.time()
+    pool = multiprocessing.Pool(args.workers, initWorker, (args.target,))
+    try:
+        for result in pool.imap(processImage, filenames):
+            outfile.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        pool.close()
+        pool.join()
+        if outfile is not sys.stdout:
+            outfile.close()
+    elapsed = time.time() - start
+
+    sys.stderr.write("%d images in %.2f s (%.1f images/s) with %d workers\n"
+                     % (len(filenames), elapsed, len(filenames) / elapsed,
+                        args.workers))
+
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+
+def initWorker(target):
+    global targetGraph
+    if target is not None:
+        img = cv2.imread(target, 1)
+        pieces = indentifyPieces(findValid(img), img)
+        targetGraph = makeGraph(pieces, findConnections(pieces))
+
+#Runs the whole detection on one image and returns a JSON ready dict with
+#the pieces, connections and the seconds spent in each stage.
+def processImage(filename):
+    result = {"file": filename}
+    times = {}
+    try:
+        start = time.time()
+        img = cv2.imread(filename, 1)
+        if img is None:
+            raise IOError("Could not read " + filename)
+        times["imread"] = time.time() - start
+
+        start = time.time()
+        valid = findValid(img)
+        times["findValid"] = time.time() - start
+
+        start = time.time()
+        pieces = indentifyPieces(valid, img)
+        times["indentifyPieces"] = time.time() - start
+
+        start = time.time()
+        connections = findConnections(pieces)
+        times["findConnections"] = time.time() - start
+
+        start = time.time()
+        g = makeGraph(pieces, connections)
+        times["makeGraph"] = time.time() - start
+
+        result["pieces"] = [pieceToDict(piece) for piece in pieces]
+        result["connections"] = [connectionToDict(connection, pieces)
+                                 for connection in connections]
+        if targetGraph is not None:
+            start = time.time()
+            result["matchesTarget"] = bool(g == targetGraph)
+            times["compare"] = time.time() - start
+    except Exception as e:
+        result["error"] = repr(e)
+    result["times"] = times
+    return result
+
+def pieceToDict(piece):
+    theta = piece.theta
+    if theta is not None:
+        theta = float(theta)
+    return {
+        "name": piece.name,
+        "center": [float(piece.center[0]), float(piece.center[1])],
+        "theta": theta,
+        "vertices": piece.contour.reshape(-1, 2).tolist()
+    }
+
+def connectionToDict(connection, pieces):
+    return {
+        "type": connection.connectionType,
+        "pieces": [pieces.index(piece) for piece in connection.pieces],
+        "locationNumbers": connection.locationNumbers
+    }
+
+if __name__ == "__main__":
+    main()
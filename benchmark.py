@@ -0,0 +1,325 @@
+import numpy as np
+import cv2
+import copy
+import gc
+import os
+import sys
+import tempfile
+import time
+import timeit
+from Tangrams import *
+from TangramsGraph import *
+from TangramsLibrary import *
+from TangramsScenes import *
+from TangramsStates import *
+
+def main():
+    if len(sys.argv) > 1:
+        name = sys.argv[1]
+    else:
+        name = "all"
+
+    if name not in BENCHMARKS and name != "all":
+        print("Benchmarks: " + ", ".join(sorted(BENCHMARKS)) + ", all")
+        sys.exit()
+
+    for current in sorted(BENCHMARKS):
+        if name in (current, "all"):
+            BENCHMARKS[current]()
+
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+
+#Returns the best time in seconds of a few runs of the given function.
+def bestTime(function, number = 3, repeat = 3):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+#Returns count square pieces spread out at about the density of one tangram
+#set per camera frame, so the number of neighbors per piece stays the same.
+def randomPieces(count, seed = 0):
+    rng = np.random.RandomState(seed)
+    #A 640 x 480 frame holds about seven pieces.
+    scale = np.sqrt(count / 7.0)
+    pieces = []
+    for i in range(count):
+        center = rng.uniform(0, 1, 2) * [640 * scale, 480 * scale]
+        angle = rng.uniform(0, np.pi / 2)
+        corners = [angle + k * np.pi / 2 for k in range(4)]
+        contour = [[center[0] + 40 * np.cos(a), center[1] + 40 * np.sin(a)]
+                   for a in corners]
+        pieces.append(Piece(np.int32(contour).reshape(-1, 1, 2)))
+    return pieces
+
+#Times candidate pair generation and findConnections with and without the
+#PieceGrid spatial index.
+def benchSpatialIndex():
+    print("spatial index: pieces, pairs, brute/grid pairs ms, "
+          + "brute/grid findConnections ms")
+    for count in [7, 25, 50, 100, 250, 500, 1000]:
+        pieces = randomPieces(count)
+        first, second = findCandidatePairs(pieces, True)
+        brutePairs = bestTime(lambda: findCandidatePairs(pieces, False))
+        gridPairs = bestTime(lambda: findCandidatePairs(pieces, True))
+        brute = bestTime(lambda: findConnections(pieces))
+        grid = bestTime(lambda: findConnections(pieces, spatialIndex=True))
+        print("%5d %6d %9.2f %9.2f %9.2f %9.2f" % (count, len(first),
+              brutePairs * 1000, gridPairs * 1000, brute * 1000, grid * 1000))
+
+#Returns a random graph of a seven piece tangram with location numbers
+#picked at random instead of detected.
+def randomGraph(rng, templates):
+    names = ["triangle"] * 5 + ["square", "parallelogram"]
+    pieces = [copy.copy(templates[name]) for name in names]
+    connections = []
+    for i in range(1, len(pieces)):
+        for j in rng.choice(i, min(i, rng.randint(1, 3)), replace=False):
+            connection = Connection(pieces[i], pieces[j], False)
+            connection.connectionType = rng.randint(3)
+            connection.locationNumbers = [rng.randint(1, 4), rng.randint(1, 4)]
+            connections.append(connection)
+    return makeGraph(pieces, connections)
+
+#Times building, saving, loading and querying a library of 10k solutions.
+def benchLibrary(count = 10000):
+    rng = np.random.RandomState(0)
+    templates = templatePieces()
+    graphs = [randomGraph(rng, templates) for i in range(count)]
+    library = SolutionLibrary()
+
+    start = time.time()
+    for i, graph in enumerate(graphs):
+        library.addGraph("solution %d" % i, graph)
+    print("library: added %d solutions in %.2f s" % (count,
+                                                     time.time() - start))
+
+    path = os.path.join(tempfile.mkdtemp(), "library.json")
+    start = time.time()
+    library.save(path)
+    saved = time.time() - start
+    start = time.time()
+    library = loadSolutionLibrary(path)
+    print("library: save %.2f s, load %.2f s, %.1f MB" % (saved,
+          time.time() - start, os.path.getsize(path) / 1e6))
+
+    queries = graphs[:100]
+    #Clears the cached signature so hashing the query is measured too.
+    def findExact(graph):
+        graph.clearCaches()
+        return library.findExact(graph)
+    exact = bestTime(lambda: [findExact(g) for g in queries], 1)
+    nearest = bestTime(lambda: [library.findNearest(g) for g in queries], 1)
+    found = sum(len(library.findExact(g)) > 0 for g in queries)
+    print("library: findExact %.3f ms, findNearest %.3f ms per query, "
+          "%d/%d exact hits" % (exact * 10, nearest * 10, found, len(queries)))
+
+#Returns the number of objects each call of function leaves alive.
+def retainedObjects(function, number = 100):
+    gc.collect()
+    before = len(gc.get_objects())
+    kept = [function() for i in range(number)]
+    gc.collect()
+    #The list kept is one of the new objects.
+    return (len(gc.get_objects()) - before - 1) / float(number)
+
+#Compares building, copying and comparing graphs with the deep copies the
+#graph code used to make against the current shared graphs.
+def benchGraphCopies(filename = "Images/Tan6.jpg"):
+    img = cv2.imread(filename, 1)
+    pieces = indentifyPieces(findValid(img), img)
+    connections = findConnections(pieces)
+    g = makeGraph(pieces, connections)
+    h = makeGraph(pieces, connections)
+
+    def deepCompare():
+        #countsMatch used to deep copy both connection dicts.
+        copy.deepcopy(g.connections)
+        copy.deepcopy(h.connections)
+        return g == h
+
+    cases = [
+        ("makeGraph", lambda: copy.deepcopy(makeGraph(pieces, connections)),
+                      lambda: makeGraph(pieces, connections)),
+        ("copy", lambda: copy.deepcopy(g), lambda: TangramsGraph(g)),
+        ("compare", deepCompare, lambda: g == h)
+    ]
+    print("graph copies: %s, %d pieces, %d connections" % (filename,
+          len(pieces), len(connections)))
+    print("%-10s %12s %12s %14s %14s" % ("", "before ms", "after ms",
+          "before objects", "after objects"))
+    for name, before, after in cases:
+        print("%-10s %12.3f %12.3f %14.1f %14.1f" % (name,
+              bestTime(before, 20) * 1000, bestTime(after, 20) * 1000,
+              retainedObjects(before), retainedObjects(after)))
+
+#Returns count contours of tangram shapes at random places, angles and sizes,
+#a few with their corners moved so they are not pieces.
+def randomContours(count, seed = 0):
+    rng = np.random.RandomState(seed)
+    shapes = [
+        [[0, 0], [60, 0], [60, 60], [0, 60]],
+        [[0, 0], [60, 0], [0, 60]],
+        [[0, 0], [60, 0], [90, 30], [30, 30]]
+    ]
+    contours = []
+    for i in range(count):
+        shape = np.float64(shapes[rng.randint(len(shapes))])
+        angle = rng.uniform(0, 2 * np.pi)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                             [np.sin(angle), np.cos(angle)]])
+        points = (np.dot(shape, rotation.T) * rng.uniform(0.5, 2)
+                  + rng.uniform(0, 640, 2)
+                  + rng.randint(-10, 11, shape.shape) * (rng.rand() < 0.2))
+        contours.append(np.int32(points).reshape(-1, 1, 2))
+    return contours
+
+#Times classifying contours one Piece at a time against classifyContours.
+def benchClassify():
+    print("classify: contours, scalar Piece ms, indentifyPieces ms, "
+          + "classifyContours ms")
+    for count in [7, 100, 1000, 10000]:
+        contours = randomContours(count)
+        number = max(1, 1000 // count)
+        scalar = bestTime(lambda: [Piece(c) for c in contours], number)
+        batch = bestTime(lambda: indentifyPieces(contours, None), number)
+        classify = bestTime(lambda: classifyContours(contours), number)
+        print("%6d %12.2f %12.2f %12.2f" % (count, scalar * 1000,
+              batch * 1000, classify * 1000))
+
+#Times findValid against findValidPyramid on a sample image scaled up to
+#camera resolutions.
+def benchPyramid(filename = "Images/Tan6.jpg"):
+    print("pyramid: size, findValid ms, findValidPyramid ms by levels")
+    for scale in [1, 2, 3]:
+        img = cv2.imread(filename, 1)
+        img = cv2.resize(img, None, fx=scale, fy=scale)
+        full = bestTime(lambda: findValid(img), 10)
+        levels = [bestTime(lambda: findValidPyramid(img, level), 10)
+                  for level in [1, 2, 3]]
+        print("%4dx%-4d %8.2f   1: %6.2f   2: %6.2f   3: %6.2f" % (
+              img.shape[1], img.shape[0], full * 1000, levels[0] * 1000,
+              levels[1] * 1000, levels[2] * 1000))
+
+#Times the detection of synthetic 1920 x 1080 scenes with up to hundreds of
+#pieces and scores it against the scenes' truth.
+def benchScenes():
+    print("scenes: pieces, connections, detect ms, brute/grid findConnections "
+          + "ms, missing pieces, wrong or missed connections")
+    for count in [100, 300, 800]:
+        scene = makeScene(1920, 1080, count)
+        def detect():
+            pieces = indentifyPieces(findValid(scene.img), scene.img)
+            return pieces, findConnections(pieces, spatialIndex=True)
+        pieces, connections = detect()
+        score = scene.score(pieces, connections)
+        print("%5d %6d %9.1f %9.1f %9.1f %5d %5d" % (count,
+              len(scene.connections), bestTime(detect, 1) * 1000,
+              bestTime(lambda: findConnections(pieces), 1) * 1000,
+              bestTime(lambda: findConnections(pieces, spatialIndex=True), 1)
+              * 1000, score["missing"], score["wrong"] + score["missed"]))
+
+#Times findConnections with and without a ConnectionCache on a still scene
+#seen through camera noise, and checks that both give the same connections.
+def benchConnectionCache(frames = 20):
+    print("cache: pieces, findConnections ms, cached ms, hit rate, "
+          + "different connections")
+    rng = np.random.RandomState(0)
+    for count in [50, 150, 400]:
+        scene = makeScene(1920, 1080, count)
+        cache = ConnectionCache()
+        plain = cached = 0.0
+        different = 0
+        for frame in range(frames):
+            img = np.clip(scene.img + rng.normal(0, 6, scene.img.shape), 0,
+                          255).astype(np.uint8)
+            pieces = indentifyPieces(findValid(img), img)
+            start = time.time()
+            expected = findConnections(pieces, spatialIndex=True)
+            plain += time.time() - start
+            start = time.time()
+            found = findConnections(pieces, spatialIndex=True, cache=cache)
+            cached += time.time() - start
+            different += len(set(connectionKeys(expected))
+                             ^ set(connectionKeys(found)))
+        print("%5d %9.2f %9.2f %8.1f%% %5d" % (count, plain / frames * 1000,
+              cached / frames * 1000, 100 * cache.hitRate(), different))
+
+#Returns the pieces, type and location numbers of every connection.
+def connectionKeys(connections):
+    return [(id(connection.pieces[0]), id(connection.pieces[1]),
+             connection.connectionType, tuple(connection.locationNumbers))
+            for connection in connections]
+
+#Times writing and reading back state files of synthetic scenes, against the
+#old text dump of str(piece) and str(connection).
+def benchStates(frames = 100):
+    print("states: pieces, connections, text dump ms, write ms, read ms, "
+          + "bytes per frame")
+    path = os.path.join(tempfile.mkdtemp(), "states.tgs")
+    for count in [10, 100, 300]:
+        scene = makeScene(1280, 720, count)
+        def dump():
+            "".join([str(piece) + '\n' for piece in scene.pieces]
+                    + [str(connection) + '\n'
+                       for connection in scene.connections])
+        def write():
+            if os.path.exists(path):
+                os.remove(path)
+            writer = StateWriter(path)
+            for frame in range(frames):
+                writer.write(scene.pieces, scene.connections)
+            writer.close()
+        writing = bestTime(write, 1) / frames
+        reader = StateReader(path)
+        checkFrame(scene.pieces, scene.connections,
+                   *reader.read(frames // 2))
+        reading = bestTime(lambda: reader.read(frames // 2), 10)
+        reader.close()
+        print("%5d %6d %9.3f %9.3f %9.3f %9d" % (count,
+              len(scene.connections), bestTime(dump, 10) * 1000,
+              writing * 1000, reading * 1000,
+              os.path.getsize(path) // frames))
+        os.remove(path)
+
+#Raises AssertionError unless a frame read back from a state file has the
+#pieces, touching sides and points and location numbers that were written.
+def checkFrame(pieces, connections, readPieces, readConnections):
+    assert len(readPieces) == len(pieces)
+    for piece, other in zip(pieces, readPieces):
+        assert other.name == piece.name
+        assert np.array_equal(other.contour, piece.contour)
+        assert np.allclose(other.center, piece.center)
+    assert len(readConnections) == len(connections)
+    indexes = dict((id(piece), i) for i, piece in enumerate(pieces))
+    readIndexes = dict((id(piece), i) for i, piece in enumerate(readPieces))
+    for connection, other in zip(connections, readConnections):
+        assert ([readIndexes[id(piece)] for piece in other.pieces]
+                == [indexes[id(piece)] for piece in connection.pieces])
+        assert other.connectionType == connection.connectionType
+        assert (list(other.locationNumbers)
+                == list(connection.locationNumbers))
+        assert connectionContacts(other) == connectionContacts(connection)
+        for touching, otherTouching in zip(connection.touching,
+                                           other.touching):
+            if isinstance(touching, Line):
+                assert isinstance(otherTouching, Line)
+                assert np.array_equal(otherTouching.pts, touching.pts)
+            else:
+                assert np.array_equal(otherTouching.pt, touching.pt)
+
+BENCHMARKS = {
+    "cache": benchConnectionCache,
+    "classify": benchClassify,
+    "graph": benchGraphCopies,
+    "index": benchSpatialIndex,
+    "library": benchLibrary,
+    "pyramid": benchPyramid,
+    "scenes": benchScenes,
+    "states": benchStates,
+}
+
+if __name__ == "__main__":
+    main()
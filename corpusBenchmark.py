@@ -0,0 +1,241 @@
+import argparse
+import cv2
+import gc
+import json
+import platform
+import sys
+import time
+import numpy as np
+from Tangrams import *
+from TangramsGraph import *
+from TangramsSources import findImages
+try:
+    import tracemalloc
+except ImportError:
+    #Python 2 has no tracemalloc, only object counts are measured there.
+    tracemalloc = None
+
+#Stages of the detection in the order they run. findValid is split into
+#the label, findBlocks and removeDuplicates calls it makes.
+STAGES = ["label", "findBlocks", "removeDuplicates", "indentifyPieces",
+          "findConnections", "makeGraph"]
+
+#Ways to make bigger frames from the corpus images.
+VARIANTS = {
+    "original": lambda img: img,
+    "up2": lambda img: cv2.resize(img, None, fx=2, fy=2),
+    "up3": lambda img: cv2.resize(img, None, fx=3, fy=3),
+    #Four copies of the image, so four times the pieces in one frame.
+    "tile2x2": lambda img: np.tile(img, (2, 2, 1))
+}
+
+#A stage is a regression when its median is more than this many times the
+#baseline's and at least MIN_REGRESSION_MS slower.
+REGRESSION_RATIO = 1.25
+MIN_REGRESSION_MS = 0.05
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time every detection stage over a corpus of images.")
+    parser.add_argument("inputs", nargs="*", default=["Images"],
+                        help="image files, directories or glob patterns")
+    parser.add_argument("-v", "--variants", nargs="+",
+                        default=sorted(VARIANTS), choices=sorted(VARIANTS),
+                        help="frame variants to run")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="runs of each image")
+    parser.add_argument("-o", "--output",
+                        help="JSON file to save the results to")
+    parser.add_argument("-b", "--baseline",
+                        help="JSON file of earlier results to compare to, "
+                             "exits with 1 if a stage got slower")
+    parser.add_argument("-t", "--tolerance", type=float,
+                        default=REGRESSION_RATIO,
+                        help="slowdown ratio that counts as a regression")
+    args = parser.parse_args()
+
+    filenames = findImages(args.inputs)
+    if len(filenames) == 0:
+        print("No images found")
+        sys.exit(1)
+    images = [cv2.imread(filename, 1) for filename in filenames]
+
+    results = {
+        "version": 1,
+        "environment": environment(),
+        "images": filenames,
+        "repeat": args.repeat,
+        "variants": {}
+    }
+    for variant in args.variants:
+        frames = [VARIANTS[variant](img) for img in images]
+        results["variants"][variant] = runVariant(frames, args.repeat)
+        display(variant, results["variants"][variant])
+
+    if args.output is not None:
+        outfile = open(args.output, 'w')
+        json.dump(results, outfile, indent=1, sort_keys=True)
+        outfile.close()
+
+    if args.baseline is not None:
+        infile = open(args.baseline)
+        baseline = json.load(infile)
+        infile.close()
+        if compare(baseline, results, args.tolerance) > 0:
+            sys.exit(1)
+
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+
+#Versions that the timings depend on, saved with the results.
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cv2": cv2.__version__,
+        "machine": platform.machine(),
+        "cv2Threads": cv2.getNumThreads()
+    }
+
+#Returns true if the peak memory of each stage can be measured.
+def canTraceMemory():
+    return tracemalloc is not None and hasattr(tracemalloc, "reset_peak")
+
+#Runs every stage on img. Returns {stage: (seconds, objects, peak bytes)} and
+#the number of blocks, pieces and connections found. Peak bytes is None
+#unless traceMemory, which slows every stage down.
+def runStages(img, traceMemory = False):
+    measured = {}
+    def stage(name, function, *args):
+        #With the collector off, the generation 0 count goes up by one for
+        #every container object made and down for every one freed.
+        gc.disable()
+        try:
+            before = gc.get_count()[0]
+            if traceMemory:
+                tracemalloc.reset_peak()
+                memory = tracemalloc.get_traced_memory()[0]
+            start = time.time()
+            result = function(*args)
+            elapsed = time.time() - start
+            peak = None
+            if traceMemory:
+                peak = tracemalloc.get_traced_memory()[1] - memory
+            measured[name] = (elapsed, gc.get_count()[0] - before, peak)
+        finally:
+            gc.enable()
+        return result
+
+    #The same calls findValid makes, each timed on its own.
+    label, colorNames = makeLabeler(img)
+    labels = stage("label", label, img)
+    blocks = stage("findBlocks", lambda: [block
+                                          for bit in range(len(colorNames))
+                                          for block in findBlocks(labels,
+                                                                  bit)])
+    valid = stage("removeDuplicates", removeDuplicates, blocks)
+    pieces = stage("indentifyPieces", indentifyPieces, valid, img)
+    connections = stage("findConnections", findConnections, pieces)
+    stage("makeGraph", makeGraph, pieces, connections)
+
+    counts = {
+        "blocks": len(blocks),
+        "pieces": len(pieces),
+        "connections": len(connections)
+    }
+    return measured, counts
+
+#Runs every frame repeat times and returns the median and p95 milliseconds,
+#median objects and mean counts of each stage. Where tracemalloc can, every
+#frame is run once more to find the median peak KB of each stage.
+def runVariant(frames, repeat):
+    seconds = dict((stage, []) for stage in STAGES + ["total"])
+    objects = dict((stage, []) for stage in STAGES + ["total"])
+    counts = {}
+    #One untimed run so imports and lazy setup aren't measured.
+    runStages(frames[0])
+    for run in range(repeat):
+        for img in frames:
+            measured, found = runStages(img)
+            for stage in STAGES:
+                seconds[stage].append(measured[stage][0])
+                objects[stage].append(measured[stage][1])
+            seconds["total"].append(sum(measured[s][0] for s in STAGES))
+            objects["total"].append(sum(measured[s][1] for s in STAGES))
+            if run == 0:
+                for name in found:
+                    counts[name] = counts.get(name, 0) + found[name]
+
+    peaks = dict((stage, []) for stage in STAGES + ["total"])
+    if canTraceMemory():
+        tracemalloc.start()
+        for img in frames:
+            measured = runStages(img, True)[0]
+            for stage in STAGES:
+                peaks[stage].append(measured[stage][2])
+            peaks["total"].append(max(measured[s][2] for s in STAGES))
+        tracemalloc.stop()
+
+    #size is of the first frame, the corpus images may differ.
+    result = {"stages": {}, "counts": {}, "size": list(frames[0].shape[:2])}
+    for stage in STAGES + ["total"]:
+        samples = np.array(seconds[stage]) * 1000
+        result["stages"][stage] = {
+            "median": float(np.median(samples)),
+            "p95": float(np.percentile(samples, 95)),
+            "objects": float(np.median(objects[stage])),
+            "peakKB": None
+        }
+        if len(peaks[stage]) > 0:
+            result["stages"][stage]["peakKB"] = float(
+                np.median(peaks[stage]) / 1024.0)
+    for name in counts:
+        result["counts"][name] = counts[name] / float(len(frames))
+    return result
+
+def display(variant, result):
+    print("%s %dx%d, per frame: %s" % (variant, result["size"][1],
+          result["size"][0], ", ".join("%.1f %s" % (result["counts"][name],
+                                                    name)
+                                       for name in sorted(result["counts"]))))
+    print("  %-18s %10s %10s %10s %10s" % ("stage", "median ms", "p95 ms",
+                                           "objects", "peak KB"))
+    for stage in STAGES + ["total"]:
+        timing = result["stages"][stage]
+        peak = "-"
+        if timing["peakKB"] is not None:
+            peak = "%.0f" % timing["peakKB"]
+        print("  %-18s %10.3f %10.3f %10.0f %10s" % (stage, timing["median"],
+              timing["p95"], timing["objects"], peak))
+
+#Prints the change of every stage median from baseline to results and
+#returns the number of regressions.
+def compare(baseline, results, tolerance = REGRESSION_RATIO):
+    if baseline.get("version") != 1:
+        raise ValueError('Unknown benchmark results version.')
+    regressions = 0
+    print("Compared to baseline (median ms):")
+    for variant in sorted(results["variants"]):
+        if variant not in baseline["variants"]:
+            continue
+        old = baseline["variants"][variant]["stages"]
+        new = results["variants"][variant]["stages"]
+        for stage in STAGES + ["total"]:
+            if stage not in old:
+                continue
+            before = old[stage]["median"]
+            after = new[stage]["median"]
+            regressed = (after > before * tolerance
+                         and after - before > MIN_REGRESSION_MS)
+            regressions += regressed
+            print("  %-9s %-18s %9.3f -> %9.3f  %5.2fx%s" % (variant, stage,
+                  before, after, after / max(before, 1e-9),
+                  "  REGRESSION" if regressed else ""))
+    return regressions
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import copy
+import sys
+import numpy as np
+from Tangrams import *
+from TangramsGraph import *
+from TangramsScenes import templatePieces
+
+NAMES = ["square", "triangle", "parallelogram"]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check TangramsGraph equality on random graphs.")
+    parser.add_argument("-n", "--graphs", type=int, default=2000,
+                        help="random graphs to check")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="seed of the first graph")
+    parser.add_argument("-p", "--pieces", type=int, default=12,
+                        help="most pieces in a graph")
+    args = parser.parse_args()
+
+    templates = templatePieces()
+    checks = {}
+    for seed in range(args.seed, args.seed + args.graphs):
+        rng = np.random.RandomState(seed)
+        try:
+            for name, passed in checkGraph(rng, templates, args.pieces):
+                if not passed:
+                    raise AssertionError(name)
+                checks[name] = checks.get(name, 0) + 1
+        except AssertionError as error:
+            print("Failed %s with seed %d" % (error, seed))
+            sys.exit(1)
+    for name in sorted(checks):
+        print("%-28s %6d passed" % (name, checks[name]))
+
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+###########################################
+
+#Returns the pieces and connections of a random graph. Few names and location
+#numbers are used so that many connections look alike, which is where a
+#matcher that pairs them badly goes wrong.
+def randomGraph(rng, templates, maxPieces):
+    count = rng.randint(2, maxPieces + 1)
+    names = rng.choice(NAMES[:rng.randint(1, 4)], count)
+    pieces = [copy.copy(templates[name]) for name in names]
+    connections = []
+    for i in range(1, count):
+        for j in rng.choice(i, min(i, rng.randint(1, 4)), replace=False):
+            connections.append(makeConnection(pieces[i], pieces[j],
+                               rng.randint(2), [rng.randint(1, 3),
+                                                rng.randint(1, 3)]))
+    return pieces, connections
+
+def makeConnection(piece1, piece2, connectionType, locationNumbers):
+    connection = Connection(piece1, piece2, False)
+    connection.connectionType = connectionType
+    connection.locationNumbers = list(locationNumbers)
+    return connection
+
+#Returns the same graph with new piece objects, connections listed from
+#either end and everything added in a new order.
+def relabel(rng, pieces, connections):
+    copies = dict((piece, copy.copy(piece)) for piece in pieces)
+    newConnections = []
+    for connection in connections:
+        piece1, piece2 = [copies[piece] for piece in connection.pieces]
+        numbers = connection.locationNumbers
+        if rng.randint(2):
+            newConnections.append(makeConnection(piece2, piece1,
+                connection.connectionType, numbers[::-1]))
+        else:
+            newConnections.append(makeConnection(piece1, piece2,
+                connection.connectionType, numbers))
+    newPieces = [copies[piece] for piece in pieces]
+    rng.shuffle(newPieces)
+    rng.shuffle(newConnections)
+    return newPieces, newConnections
+
+#Returns the connections with one of them changed at random: its type, a
+#location number or one of its ends moved to another piece.
+def mutate(rng, pieces, connections):
+    connections = list(connections)
+    k = rng.randint(len(connections))
+    old = connections[k]
+    piece1, piece2 = old.pieces
+    connectionType = old.connectionType
+    numbers = list(old.locationNumbers)
+    change = rng.randint(3)
+    if change == 0:
+        connectionType = 1 - connectionType
+    elif change == 1:
+        end = rng.randint(2)
+        numbers[end] = 3 - numbers[end]
+    else:
+        others = [piece for piece in pieces if piece is not piece1]
+        piece2 = others[rng.randint(len(others))]
+    connections[k] = makeConnection(piece1, piece2, connectionType, numbers)
+    return connections
+
+#Returns true if every connection of g can be paired with a different
+#connection of h for which isSimilar and PieceCountsMatch are true. Tries
+#every augmenting path, without countsMatch's assumption that the pairs fall
+#into buckets.
+def referenceCountsMatch(g, h):
+    if(     len(g.connections) != len(h.connections)
+        or  len(g.pieces) != len(h.pieces) ):
+        return False
+    left = list(g.connections)
+    right = list(h.connections)
+    edges = []
+    for connection in left:
+        counts = [g.getPieceCounts(piece) for piece in connection.pieces]
+        edges.append([n for n, other in enumerate(right)
+                      if connection.isSimilar(other)
+                      and g.PieceCountsMatch(counts[0], counts[1],
+                          h.getPieceCounts(other.pieces[0]),
+                          h.getPieceCounts(other.pieces[1]))])
+    pairedWith = [None] * len(right)
+
+    def augment(m, seen):
+        for n in edges[m]:
+            if n in seen:
+                continue
+            seen.add(n)
+            if pairedWith[n] is None or augment(pairedWith[n], seen):
+                pairedWith[n] = m
+                return True
+        return False
+
+    return all(augment(m, set()) for m in range(len(left)))
+
+#Yields (check name, passed) for the checks of one random graph.
+def checkGraph(rng, templates, maxPieces):
+    pieces, connections = randomGraph(rng, templates, maxPieces)
+    g = makeGraph(pieces, connections)
+
+    #The same graph built another way is equal.
+    h = makeGraph(*relabel(rng, pieces, connections))
+    yield "relabeled signature", g.signature() == h.signature()
+    yield "relabeled equal", g == h and h == g
+    yield "relabeled reference", referenceCountsMatch(g, h)
+    yield "copy equal", TangramsGraph(g) == g
+
+    #countsMatch agrees with the reference on a changed graph and on an
+    #unrelated graph of the same size.
+    changed = makeGraph(pieces, mutate(rng, pieces, connections))
+    yield "mutated countsMatch", (g.countsMatch(changed)
+                                  == referenceCountsMatch(g, changed))
+    other = makeGraph(*randomGraph(rng, templates, maxPieces))
+    yield "random countsMatch", (g.countsMatch(other)
+                                 == referenceCountsMatch(g, other))
+
+    #Changing a graph in place gives the same graph as building it again.
+    live = TangramsGraph(g)
+    live.signature()
+    live.connectionKeyCounts()
+    for connection in connections:
+        if rng.randint(3) == 0:
+            live.removeConnection(connection)
+    removed = [piece for piece in pieces if rng.randint(5) == 0]
+    for piece in removed:
+        live.removePiece(piece)
+    added = mutate(rng, pieces, connections)[-1:]
+    for connection in added:
+        if all(piece in live.pieces for piece in connection.pieces):
+            live.addConnection(connection)
+    rebuilt = makeGraph(list(live.pieces), list(live.connections))
+    yield "incremental signature", (live.signature()
+                                    == graphSignature(live)
+                                    == rebuilt.signature())
+    yield "incremental key counts", (live.connectionKeyCounts()
+                                     == rebuilt.connectionKeyCounts())
+    yield "incremental equal", live == rebuilt
+
+if __name__ == "__main__":
+    main()
@@ -13,8 +13,8 @@ def main():
         print("Invalid input")
         sys.exit()
 
-    g = makeGraphFromImage(filename1)
-    f = makeGraphFromImage(filename2)
+    g = makeGraphFromImage(filename1, cv2.imshow)
+    f = makeGraphFromImage(filename2, cv2.imshow)
 
     graphTest(f, g)
 
@@ -31,7 +31,9 @@ def main():
 ###########################################
 ###########################################
 
-def makeGraphFromImage(filename):
+#debug is an optional sink called as debug(name, image) with the color
+#masks and the drawn pieces and connections, for example cv2.imshow.
+def makeGraphFromImage(filename, debug = None):
     img = cv2.imread(filename, 1)
 
     #Create Empty lists for pieces and connections.
@@ -39,21 +41,21 @@ def makeGraphFromImage(filename):
     connections = []
 
     #Find pieces and connections.
-    valid = findValid(img)
+    valid = findValid(img, debug=debug)
     pieces = indentifyPieces(valid, img)
     connections = findConnections(pieces)
 
-    #Create blank image to draw on.
-    blank = np.zeros(img.shape)
+    if debug is not None:
+        #Create blank image to draw on.
+        blank = np.zeros(img.shape)
 
-    #Draw pieces and connections.
-    drawPieces(blank, pieces)
-    drawConnections(img, connections)
+        #Draw pieces and connections.
+        drawPieces(blank, pieces)
+        drawConnections(img, connections)
 
-
-    # Display the resulting images.
-    cv2.imshow('blank '+filename, blank)
-    cv2.imshow('frame '+filename, img)
+        # Display the resulting images.
+        debug('blank '+filename, blank)
+        debug('frame '+filename, img)
 
 
     g = makeGraph(pieces, connections)
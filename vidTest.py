@@ -1,22 +1,113 @@
 import numpy as np
 import cv2
 import datetime
+import sys
 from Tangrams import *
+from TangramsPipeline import DetectionPipeline
+from TangramsTracker import PieceTracker
+from TangramsChanges import IncrementalDetector
+from TangramsStats import StageStats, setStats
+from TangramsSources import CameraSource, openSource, measureThroughput
+from TangramsStates import StateWriter
 
 def main():
-    cap = cv2.VideoCapture( 1 )
+    #A camera index, video file or directory of frames, camera 1 by default.
+    if "--source" in sys.argv:
+        cap = openSource(sys.argv[sys.argv.index("--source") + 1])
+    else:
+        cap = CameraSource( 1 )
+
+    #Times every detection stage and counts what it finds.
+    stats = None
+    if "--stats" in sys.argv:
+        stats = StageStats()
+        setStats(stats)
+
+    #Reuses the connections of pairs of pieces that look the same as in an
+    #earlier frame.
+    cache = None
+    if "--cache" in sys.argv:
+        cache = ConnectionCache()
+
+    #Keeps pieces that didn't move instead of rebuilding them every frame.
+    tracker = None
+    if "--track" in sys.argv:
+        tracker = PieceTracker(cache=cache)
+    #Segments a quarter size frame and refines the pieces at full size.
+    find = findValid
+    if "--pyramid" in sys.argv:
+        find = lambda img, debug = None: findValidPyramid(img, 2, debug=debug)
+    #Skips frames, and parts of frames, that didn't change.
+    changes = None
+    if "--changes" in sys.argv:
+        changes = IncrementalDetector(tracker, find=find, cache=cache)
+
+    def detect(img, debug = None):
+        if changes is not None:
+            return changes.update(img)
+        valid = find(img, debug=debug)
+        if tracker is not None:
+            return tracker.update(valid)
+        pieces = indentifyPieces(valid, img)
+        return pieces, findConnections(pieces, cache=cache)
+
+    #Appends the pieces and connections of every frame to a state file.
+    recorder = None
+    if "--record" in sys.argv:
+        recorder = StateWriter(sys.argv[sys.argv.index("--record") + 1])
+    def onResult(result):
+        if recorder is not None:
+            recorder.write(*result)
+        if stats is not None:
+            stats.endFrame()
+
+    def finish():
+        if changes is not None:
+            changes.report()
+        if cache is not None:
+            cache.report()
+        if recorder is not None:
+            recorder.close()
+
+    #Capture, detection and rendering on separate threads. The pipeline ends
+    #the stats frames and reports them itself. The tracker, change detector,
+    #cache and recording keep state from one frame to the next, so with any
+    #of them there is a single detection worker.
+    if "--pipeline" in sys.argv:
+        def detectFrame(frame):
+            frame.pieces, frame.connections = detect(frame.img)
+            if recorder is not None:
+                recorder.write(frame.pieces, frame.connections)
+            return frame
+        stateful = any(option is not None
+                       for option in [tracker, changes, cache, recorder])
+        runPipeline(cap, detectFrame, 1 if stateful else 2)
+        finish()
+        return
+
+    #Detects every frame of a recorded source as fast as it can, without
+    #windows, and prints the frames per second.
+    if "--replay" in sys.argv:
+        frames, seconds, fps = measureThroughput(cap, detect,
+                                                 onResult=onResult)
+        print("Replayed %d frames in %.2f s, %.1f fps" % (frames, seconds,
+                                                          fps))
+        finish()
+        if stats is not None:
+            stats.display()
+        cap.release()
+        return
 
     pieces = []
     connections = []
-    frameCount = 0
     while( True ):
         # Capture frame-by-frame
         ret, img = cap.read()
+        if not ret:
+            break
 
-        if(frameCount%20 == 0):
-            valid = findValid(img)
-            pieces = indentifyPieces(valid, img)
-            connections = findConnections(pieces)
+        pieces, connections = detect(img, cv2.imshow)
+        onResult((pieces, connections))
 
         blank = np.zeros(img.shape)
 
@@ -33,6 +124,10 @@ def main():
         if(currentWaitKey == ord('r')):
             writeStateToFile(pieces, connections)
 
+    finish()
+    if stats is not None:
+        stats.display()
+
     # When everything is done, release the capture
     cap.release()
     cv2.destroyAllWindows()
@@ -44,17 +139,28 @@ def main():
 ###########################################
 ###########################################
 
+def runPipeline(cap, detect, workers = 2):
+    def onKey(key, frame):
+        if(key == ord('q')):
+            return False
+        if(key == ord('r') and frame is not None):
+            writeStateToFile(frame.pieces, frame.connections)
+
+    pipeline = DetectionPipeline(cap, workers, detect=detect)
+    pipeline.run(onKey)
+
+    # When everything is done, release the capture
+    cap.release()
+    cv2.destroyAllWindows()
+
 #TODO REMOVE? Probably not needed.
+#Saves the pieces and connections as a one frame state file, read it back
+#with TangramsStates.StateReader.
 def writeStateToFile(pieces, connections):
     currentTime = str( datetime.datetime.now() )[:-7]
-    outfile = open("state_" + currentTime, 'w+')
-    for piece in pieces:
-        outfile.write(str(piece) + '\n')
-    outfile.write('\n')
-    for connection in connections:
-        outfile.write(str(connection) + '\n')
-
-    outfile.close()
+    writer = StateWriter("state_" + currentTime + ".tgs")
+    writer.write(pieces, connections)
+    writer.close()
 
 
 if __name__ == "__main__":